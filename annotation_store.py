@@ -0,0 +1,165 @@
+import os
+import json
+import sqlite3
+import threading
+from typing import Optional, List, Dict, Iterable
+
+# Bump this when the layout of the index changes.
+IndexFormatVersion = 1
+IndexSuffix = ".idx.sqlite"
+
+class AnnotationStore:
+    """ Indexed read-only view of a TSV database file (BiGG, MetaNetX, ...).
+
+    The records are copied into a SQLite file next to the source once,
+    and looked up by the primary key without loading the whole file into memory.
+    The index is rebuilt automatically when the source file changes.
+
+    key_column: the column used as the key.
+    has_header: the first (non comment) line is the column names.
+    comment_prefix: lines starting with it are skipped.
+    field_count: if set, records with a different number of fields are skipped.
+    """
+    def __init__(self, db_path: str, key_column: int = 0, has_header: bool = True,
+            comment_prefix: Optional[str] = None, field_count: Optional[int] = None):
+        self.db_path = db_path
+        self.index_path = db_path + IndexSuffix
+        self.key_column = key_column
+        self.has_header = has_header
+        self.comment_prefix = comment_prefix
+        self.field_count = field_count
+        self.columns = []
+        self.lock = threading.Lock()
+        self.connection = None
+        self.signature = None
+
+    def _source_signature(self):
+        st = os.stat(self.db_path)
+        return "{}:{}:{}".format(IndexFormatVersion, st.st_mtime_ns, st.st_size)
+
+    def _read_meta(self, connection):
+        try:
+            rows = connection.execute("SELECT name, value FROM meta").fetchall()
+        except sqlite3.DatabaseError:
+            return {}
+        return dict(rows)
+
+    def _iter_records(self, f):
+        header_found = not self.has_header
+        for line in f:
+            if self.comment_prefix != None and line.startswith(self.comment_prefix):
+                continue
+            record = line.rstrip('\r\n').split('\t')
+            if not header_found:
+                self.columns = record
+                header_found = True
+                continue
+            if self.field_count != None and len(record) != self.field_count:
+                continue
+            if len(record) <= self.key_column:
+                continue
+            yield (record[self.key_column], line.rstrip('\r\n'))
+
+    def _build(self, signature: str):
+        print("build the index of {}".format(self.db_path))
+        tmp_path = "{}.{}.tmp".format(self.index_path, os.getpid())
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        connection = sqlite3.connect(tmp_path)
+        try:
+            connection.execute("CREATE TABLE records (key TEXT PRIMARY KEY, line TEXT)")
+            connection.execute("CREATE TABLE meta (name TEXT PRIMARY KEY, value TEXT)")
+            with open(self.db_path) as f:
+                # Keep the first record if the key is duplicated.
+                connection.executemany("INSERT OR IGNORE INTO records VALUES (?, ?)", self._iter_records(f))
+            connection.executemany("INSERT INTO meta VALUES (?, ?)", [
+                ("signature", signature), ("columns", json.dumps(self.columns))])
+            connection.commit()
+        finally:
+            connection.close()
+        # Rename atomically, not to expose the half-built index to other workers.
+        os.replace(tmp_path, self.index_path)
+
+    def _connect(self):
+        """ Open the index, (re)building it if it does not match the source file. """
+        signature = self._source_signature()
+        if self.connection != None and self.signature == signature:
+            return self.connection
+        if self.connection != None:
+            self.connection.close()
+            self.connection = None
+
+        meta = {}
+        if os.path.isfile(self.index_path):
+            connection = sqlite3.connect(self.index_path, check_same_thread=False)
+            meta = self._read_meta(connection)
+            connection.close()
+        if meta.get("signature") != signature:
+            self._build(signature)
+
+        self.connection = sqlite3.connect("file:{}?mode=ro".format(self.index_path), uri=True, check_same_thread=False)
+        self.columns = json.loads(self._read_meta(self.connection)["columns"])
+        self.signature = signature
+        return self.connection
+
+    def get(self, key: str) -> Optional[List[str]]:
+        """ Returns the fields of the record, or None if the key is not found. """
+        with self.lock:
+            row = self._connect().execute("SELECT line FROM records WHERE key = ?", (key,)).fetchone()
+        if row == None:
+            return None
+        return row[0].split('\t')
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, List[str]]:
+        """ Returns {key: fields} of the found records. """
+        keys = list(set(keys))
+        ret = {}
+        # SQLite limits the number of the host parameters in a statement.
+        chunk_size = 500
+        with self.lock:
+            connection = self._connect()
+            for i in range(0, len(keys), chunk_size):
+                chunk = keys[i:i + chunk_size]
+                query = "SELECT key, line FROM records WHERE key IN ({})".format(",".join("?" * len(chunk)))
+                for key, line in connection.execute(query, chunk):
+                    ret[key] = line.split('\t')
+        return ret
+
+    def get_record(self, key: str) -> Dict[str, str]:
+        """ Returns the record as {column_name: value}, or {} if the key is not found. """
+        data = self.get(key)
+        if data == None:
+            return {}
+        return dict(zip(self.columns, data))
+
+    def build(self):
+        with self.lock:
+            self._connect()
+
+    def close(self):
+        with self.lock:
+            if self.connection != None:
+                self.connection.close()
+                self.connection = None
+                self.signature = None
+
+
+_store_lock = threading.Lock()
+_store_table = {}
+
+def get_store(db_path: str, **options) -> AnnotationStore:
+    """ Returns the process-wide store of the database file. """
+    key = (os.path.abspath(db_path), tuple(sorted(options.items())))
+    with _store_lock:
+        store = _store_table.get(key)
+        if store == None:
+            store = AnnotationStore(db_path, **options)
+            _store_table[key] = store
+    return store
+
+def close_all_stores():
+    """ Close the connections, e.g. before fork(). They are reopened on the next lookup. """
+    with _store_lock:
+        stores = list(_store_table.values())
+    for store in stores:
+        store.close()
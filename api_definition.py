@@ -56,6 +56,12 @@ schema = {
             "queryParameters": [
                 {"id": "command", "type" : "list[str]"},
                 {"id": "view_name", "type" : "str"},
+                {"id": "format", "type" : "str"},
+                {"id": "tolerance", "type" : "float"},
+                {"id": "reference", "type" : "str"},
+                {"id": "reference_command", "type" : "list[str]"},
+                {"id": "delta_threshold", "type" : "float"},
+                {"id": "stream", "type" : "bool"},
             ]
         }, 
         "responce": {
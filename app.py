@@ -1,32 +1,110 @@
-from fastapi import FastAPI, Response, Query, HTTPException
+from fastapi import FastAPI, Request, Response, Query, HTTPException
 from obj_manager import ModelViewManager, DataDir
 from model_handler import ModelHandler
-from typing import Tuple, List, Union
+from model_cache import model_cache
+from view_cache import view_cache
+from solution_cache import solution_cache
+from worker_pool import worker_pool, WorkerPoolBusy
+from compiled_model import source_checksum
+from file_io import run_io
+from jobs import job_manager
+import flux_format as flux_formatter
+import metrics
+from fast_json import FastJSONResponse, streaming_json_response
+import http_cache
+from profiling import request_profiler, profiled, ProfileHeader, ProfileQuery, ProfilePathHeader, RequestIdHeader
+from typing import List, Union
 import os
-from fastapi.encoders import jsonable_encoder
-from fastapi.responses import JSONResponse
+import time
+from fastapi.responses import JSONResponse, PlainTextResponse
+from pydantic import BaseModel
 
 class XMLResponse(Response):
     media_type = "application/xml"
 
 ARGUMENT_DELIMITER='-'
 
-app = FastAPI()
+class SolveBatchRequest(BaseModel):
+    scenarios: List[List[str]]
+    view_name: Union[str, None] = None
+    objective_only: bool = False
+
+class SolveJobRequest(BaseModel):
+    command: List[str] = []
+    view_name: Union[str, None] = None
+
+class AnnotationRequest(BaseModel):
+    ids: List[str]
+    db_src: Union[str, None] = None
+    view_name: Union[str, None] = None
+
+app = FastAPI(default_response_class=FastJSONResponse)
 object_manager = ModelViewManager()
 
+@app.middleware("http")
+async def refresh_registry(request, call_next):
+    # Pick up the models registered by the other workers, off the event loop.
+    if object_manager.refresh_due():
+        await run_io(object_manager.refresh)
+    return await call_next(request)
+
+@app.middleware("http")
+async def measure_request(request, call_next):
+    """ Collect the stage timings of the request, and report them in the Server-Timing header. """
+    collector, token = metrics.start_collector()
+    metrics.requests_in_flight.inc()
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.requests_in_flight.dec()
+        metrics.stop_collector(token)
+        # The path template, not to make a series for each model name.
+        route = request.scope.get("route")
+        route_path = route.path if route != None else "unmatched"
+        metrics.request_duration.observe((route_path, request.method), elapsed)
+        metrics.requests_total.inc((route_path, request.method, str(status)))
+        collector.flush()
+    if metrics.ServerTimingEnabled:
+        response.headers["Server-Timing"] = collector.server_timing(elapsed)
+    return response
+
+@app.middleware("http")
+async def profile_request(request, call_next):
+    """ Profile the request if it is requested by the header (or sampled). See profiling.py. """
+    flag = request.headers.get(ProfileHeader, request.query_params.get(ProfileQuery))
+    if not request_profiler.is_requested(request.url.path, flag):
+        return await call_next(request)
+    profiled_request, token = request_profiler.start(request.headers.get(RequestIdHeader))
+    try:
+        response = await call_next(request)
+    finally:
+        request_profiler.stop(token)
+    response.headers[RequestIdHeader] = profiled_request.request_id
+    if profiled_request.path != None:
+        response.headers[ProfilePathHeader] = profiled_request.path
+    return response
+
+@app.exception_handler(WorkerPoolBusy)
+async def worker_pool_busy_handler(request, exc: WorkerPoolBusy):
+    return JSONResponse(status_code=503, content={"detail": str(exc)})
+
 @app.get("/list_models")
-def list_models():
+async def list_models():
     """Returns the list of available models."""
     model_list = object_manager.list_models()
     return {"models": model_list}
 
 @app.get("/user_model_tree")
-def user_model_tree():
+async def user_model_tree():
     tree = object_manager.get_user_model_tree()
-    return {"tree": tree}
+    return FastJSONResponse(content={"tree": tree})
 
 @app.get("/list_views/", responses={404: {'description': 'Model not found'}})
-def list_views(model_name: str = Query(None) ):
+async def list_views(model_name: str = Query(None) ):
     """
     Returns available views.
     If the 'model_name' is specified as a query parameter, 
@@ -40,87 +118,68 @@ def list_views(model_name: str = Query(None) ):
 
 
 @app.get("/open_sbml/{model_name}", response_class=XMLResponse, responses={404: {'description': 'Model not found'}})
-def open_sbml(model_name: str):
+async def open_sbml(model_name: str, request: Request):
+    """Returns the SBML file. It is streamed from the disk, and the Range header is supported. 
+
+    The ETag (checksum of the file) and Last-Modified headers are returned, and 304 if the client has the same file.
+    The file is sent compressed by gzip (or brotli) if the client accepts it.
+    """
     if model_name not in object_manager.list_models():
         raise HTTPException(status_code=404, detail="Model not found")
     model_path = object_manager.model_property(model_name)["path"]
-    data = None
-    with open(model_path, 'r') as f:
-        data = f.read()
-    return Response(content=data, media_type="application/xml")
+    return await run_io(http_cache.file_response, request.headers, model_path, "application/xml")
 
 
 @app.get("/get_model_property/{model_name}", responses={404: {'description': 'Model not found'}})
-def get_model_property(model_name: str):
-    """Returns the model property, such as reference database, version. """
+async def get_model_property(model_name: str, request: Request):
+    """Returns the model property, such as reference database, version. It supports the ETag as 'open_sbml'. """
     if model_name not in object_manager.list_models():
         raise HTTPException(status_code=404, detail="Model not found")
     data = object_manager.model_property(model_name)
-    return data
+    return http_cache.json_response(request.headers, data, object_manager.base_model_signature[0] / 1e9)
 
 @app.get("/open_view/{view_name}", responses={404: {'description': 'View not found'}})
-def open_view(view_name: str):
-    """Returns the view in .cyjs format"""
-    import json
+async def open_view(view_name: str, request: Request):
+    """Returns the view in .cyjs format. It is streamed from the disk, and the Range header is supported. 
+
+    The ETag, Last-Modified and the compression are supported as 'open_sbml'.
+    """
     if view_name not in object_manager.list_views(view_name):
         raise HTTPException(status_code=404, detail="View not found")
     view_path = object_manager.view_property(view_name)["path"]
-    data = None
-    with open(view_path, 'r') as f:
-        data = json.load(f)
-    return data
+    return await run_io(http_cache.file_response, request.headers, view_path, "application/json")
 
 @app.get("/get_view_property/{view_name}", responses={404: {'description': 'Model not found'}})
-def get_view_property(view_name: str):
-    """Returns the view property, such as reference database, version. """
+async def get_view_property(view_name: str, request: Request):
+    """Returns the view property, such as reference database, version. It supports the ETag as 'open_sbml'. """
     if view_name not in object_manager.list_views():
         raise HTTPException(status_code=404, detail="Model not found")
     data = object_manager.view_property(view_name)
-    return data
+    return http_cache.json_response(request.headers, data, object_manager.view_signature[0] / 1e9)
 
 @app.get("/list_user_model/", responses={404: {'description': 'Model not found'}})
-def list_user_modification_models(base_model_name: str = Query(None) ):
+async def list_user_modification_models(base_model_name: str = Query(None) ):
     if base_model_name != None and base_model_name not in object_manager.list_models():
         raise HTTPException(status_code=404, detail="Model not found")
     user_model_list = object_manager.list_user_models(base_model_name)
     return {"user_models" : user_model_list}
 
 @app.get("/open_user_model/{user_model_name}", responses={404: {'description': 'user_model not found'}})
-def open_user_modification_models(user_model_name: str):
-    """ """
-    import yaml 
+async def open_user_modification_models(user_model_name: str, request: Request):
+    """Returns the saved user model in JSON. The ETag, Last-Modified and the compression are supported as 'open_sbml'. """
     if user_model_name not in object_manager.list_user_models():
         raise HTTPException(status_code=404, detail="UserModel not found")
     user_model_path = object_manager.user_model_property(user_model_name)['path']
-    data = None
-    with open(user_model_path, 'r') as f:
-        data = yaml.safe_load(f)
-    return data
+    return await run_io(http_cache.user_model_response, request.headers, user_model_path)
 
 
 def generate_edgeID_to_rxnID_map(view_name: str):
     """ convert reactions specified the edgeID to its original name """
-    import json
-    if view_name not in object_manager.list_views(view_name):
-        raise HTTPException(status_code=404, detail="View not found")
-    view_path = object_manager.view_property(view_name)["path"]
-    edgeID_to_rxnID ={}
-    with open(view_path, 'r') as f:
-        view = json.load(f)
-        for edge in view["elements"]["edges"]:
-            edge_id = edge["data"]["id"]
-            rxn_id = edge["data"]["bigg_id"]
-            edgeID_to_rxnID[edge_id] = rxn_id
-    return edgeID_to_rxnID
-
-def get_specified_view_path(view_name: str):
-    if view_name not in object_manager.list_views(view_name):
-        raise HTTPException(status_code=404, detail="View not found")
-    view_path = object_manager.view_property(view_name)["path"]
-    return view_path
+    view_path = get_specified_view_path(view_name)
+    return view_cache.get(view_path).edge_to_reaction
 
-@app.get("/list_reaction_id", responses={404: {'description': 'Model not found'}} )
-def list_reaction_ids(model_name: str):
+def load_model_handler(model_name: str):
+    """ Returns the ModelHandler of either the base_model or the user_model. """
     model_type = object_manager.check_model_type(model_name)
     model_handler = ModelHandler() 
     if model_type == "base_model" :
@@ -131,11 +190,44 @@ def list_reaction_ids(model_name: str):
         model_handler.load_user_model(model_path)
     else:
         raise HTTPException(status_code=404, detail="Model not found")
-    return model_handler.list_reaction_ids()
+    return model_handler
+
+def load_reference_model_handler(model_name: str, model_handler: ModelHandler, reference: str, 
+        reference_command: Union[List[str], None], view_name: Union[str, None]):
+    """ Returns the ModelHandler of the reference scenario of 'solve'. """
+    if reference == "base":
+        return load_model_handler(model_handler.get_base_model_name())
+    elif reference == "parent":
+        if object_manager.check_model_type(model_name) == "user_model":
+            return load_model_handler(object_manager.user_model_property(model_name)["parent_model"])
+        return load_model_handler(model_name)
+    else:
+        reference_handler = load_model_handler(model_name)
+        if view_name != None:
+            reference_handler.set_id_type( get_specified_view_path(view_name) )
+        for cmd in (reference_command or []):
+            reference_handler.add_modification_command(cmd.split(ARGUMENT_DELIMITER))
+        return reference_handler
+
+def get_specified_view_path(view_name: str):
+    if view_name not in object_manager.list_views(view_name):
+        raise HTTPException(status_code=404, detail="View not found")
+    view_path = object_manager.view_property(view_name)["path"]
+    return view_path
+
+@app.get("/list_reaction_id", responses={404: {'description': 'Model not found'}} )
+@profiled
+def list_reaction_ids(model_name: str):
+    model_handler = load_model_handler(model_name)
+    return FastJSONResponse(content=worker_pool.run(model_handler.list_reaction_ids))
 
 
 @app.get("/solve/{model_name}/", responses={404: {'description': 'Model not found'}} )
-def solve(model_name: str, command : Union[List[str], None] = Query(default=None), view_name: str = Query(default=None)):
+@profiled
+def solve(model_name: str, command : Union[List[str], None] = Query(default=None), view_name: str = Query(default=None),
+        flux_format: str = Query(default="pairs", alias="format"), tolerance: float = Query(default=1e-9),
+        reference: str = Query(default=None), reference_command: Union[List[str], None] = Query(default=None),
+        delta_threshold: float = Query(default=1e-9), stream: bool = Query(default=False)):
     """ Solve the model.
 
     Parameters:
@@ -146,6 +238,19 @@ def solve(model_name: str, command : Union[List[str], None] = Query(default=None
 
     view_name: If reactions in commands are specified by the edgeID of the view, specify the view.
 
+    format: format of the fluxes. 'pairs'(default), 'sparse', 'columnar' or 'npy'. Details are described below.
+
+    tolerance: fluxes whose absolute values are not greater than this are omitted in the 'sparse' format.
+
+    reference: If set, only the difference from the reference solution is returned. Details are described below.
+
+    reference_command: commands of the reference scenario, if 'reference' is 'command'.
+
+    delta_threshold: fluxes which differ from the reference by not more than this are omitted.
+
+    stream: If true, the fluxes are encoded and sent in chunks, instead of building the whole response in memory.
+    It is for the genome-scale models, and applies to the 'pairs', 'sparse' and 'columnar' formats without 'reference'.
+
     About command:
     ---
     The parameter 'command' are used to modify the model for the calculation. 
@@ -156,24 +261,37 @@ def solve(model_name: str, command : Union[List[str], None] = Query(default=None
     As another example, 'bound-q8_c-0-2' set the 0 for the lowerer bound and 2 for the upper bound of the reaction q8_c, respectively.
 
     In order to set the multiple modicications, specify like 'command=knockout-succ_p&command=bound-q8_c-0-2'.
+
+    About format:
+    ---
+    'pairs' returns the list of [reaction_id, flux].
+    'sparse' returns only the nonzero fluxes in the same form.
+    'columnar' returns the flat list of the fluxes, ordered by the reaction index of the model (see 'reaction_index').
+    'version' in the response must match the version of the reaction index.
+    'npy' returns the same array as 'columnar' encoded by numpy.save(), 
+    with the objective value in the 'X-Objective-Value' header.
+
+    About reference:
+    ---
+    'base' compares with the base model without any modification.
+    'parent' compares with the parent model of the user model (see 'user_model_tree'), 
+    or the model itself without 'command' if 'model_name' is a base model.
+    'command' compares with the model modified by 'reference_command' instead of 'command'.
+    The response contains 'changed', the list of [reaction_id, reference flux, flux] whose flux changed.
+    The difference is always returned in this form: 'format' other than 'pairs' and 'stream' can not be
+    combined with 'reference' (400), and 'delta_threshold' is used instead of 'tolerance'.
     """
-    model_type = object_manager.check_model_type(model_name)
-    model_handler = ModelHandler() 
-    if model_type == "base_model" :
-        model_path = object_manager.model_property(model_name)["path"]
-        model_handler.set_base_model(model_name, model_path)
-    elif model_type == "user_model":
-        model_path = object_manager.user_model_property(model_name)["path"]
-        model_handler.load_user_model(model_path)
-    else:
-        raise HTTPException(status_code=404, detail="Model not found")
+    if not flux_format in flux_formatter.FluxFormats:
+        raise HTTPException(status_code=400, detail="Unknown format: {}".format(flux_format))
+    if not reference in (None, "base", "parent", "command"):
+        raise HTTPException(status_code=400, detail="Unknown reference: {}".format(reference))
+    if reference != None and (flux_format != "pairs" or stream):
+        raise HTTPException(status_code=400, detail="'format' and 'stream' can not be used with 'reference'")
+    model_handler = load_model_handler(model_name)
 
     # if reactions are specified by the edge-index instead of ID,
-    #  make a table to convert them.
-    edgeID_to_rxnID = None
+    #  the table of the view converts them.
     if view_name != None:
-        #edgeID_to_rxnID = generate_edgeID_to_rxnID_map(view_name)
-        edgeID_to_rxnID = None 
         model_handler.set_id_type( get_specified_view_path(view_name) )
 
     # If the model-operation commands are submitted, apply the commands
@@ -183,10 +301,202 @@ def solve(model_name: str, command : Union[List[str], None] = Query(default=None
             print(tokens)
             model_handler.add_modification_command(tokens)
     # Do FBA!
-    data = model_handler.do_FBA()
-    return data
+    data = worker_pool.run(model_handler.do_FBA)
+
+    if reference != None:
+        # The reference solution is usually served from the solution cache.
+        reference_handler = load_reference_model_handler(model_name, model_handler, reference, reference_command, view_name)
+        reference_data = worker_pool.run(reference_handler.do_FBA)
+        with metrics.stage("format"):
+            ret = flux_formatter.flux_delta(data, reference_data, delta_threshold)
+    else:
+        version = source_checksum(model_handler.base_model_path)
+        if stream and flux_format != "npy":
+            return streaming_json_response(flux_formatter.stream_solution(data, flux_format, tolerance, version))
+        with metrics.stage("format"):
+            ret = flux_formatter.format_solution(data, flux_format, tolerance, version)
+    if isinstance(ret, Response):
+        return ret
+    # The fluxes are plain numbers. Skip jsonable_encoder(), which walks every element.
+    return FastJSONResponse(content=ret)
+
+@app.get("/reaction_index/{model_name}", responses={404: {'description': 'Model not found'}} )
+@profiled
+def get_reaction_index(model_name: str):
+    """ Returns the order of the reactions used by the 'columnar' and 'npy' formats of 'solve'.
+
+    The order is fixed for each version of the base model, so clients can keep it until the version changes.
+    """
+    model_handler = load_model_handler(model_name)
+    reaction_ids = worker_pool.run(model_handler.list_reaction_ids)
+    return FastJSONResponse(content={
+        "version": source_checksum(model_handler.base_model_path),
+        "reaction_ids": flux_formatter.reaction_index(reaction_ids)
+    })
+
+# Number of the worker processes one FVA is split across. It can be set by the environment variable KOSMOGORA_FVA_PROCESSES.
+FVAProcesses = int(os.environ.get("KOSMOGORA_FVA_PROCESSES", max(worker_pool.workers, 1)))
+
+@app.get("/fva/{model_name}/", responses={404: {'description': 'Model not found'}} )
+@profiled
+def fva(model_name: str, command : Union[List[str], None] = Query(default=None), view_name: str = Query(default=None),
+        reaction: Union[List[str], None] = Query(default=None), restrict_to_view: bool = Query(default=False),
+        fraction_of_optimum: float = Query(default=1.0, ge=0.0, le=1.0)):
+    """ Flux variability analysis. Returns the minimum and maximum flux of each reaction.
+
+    Parameters:
+    ---
+    model_name: model name, such as iJO1366. Both base_model and user_defined_model can be specified.
+
+    command: additional command to modify the model. The format is the same as 'solve'.
+
+    view_name: If reactions in commands (and 'reaction') are specified by the edgeID of the view, specify the view.
+
+    reaction: reactions to be analyzed, such as 'reaction=MDH&reaction=PGI'. All the reactions if not specified.
+
+    restrict_to_view: If true, the reactions drawn in the view 'view_name' are analyzed.
+
+    fraction_of_optimum: the objective must be at least this fraction of its optimum (0 to 1).
+
+    The response contains 'ranges', the list of [reaction_id, minimum, maximum],
+    and 'not_found', the reactions not in the model.
+    The results are cached for each effective model.
+    """
+    model_handler = load_model_handler(model_name)
+    reaction_ids = None
+    if view_name != None:
+        view_path = get_specified_view_path(view_name)
+        model_handler.set_id_type(view_path)
+        if restrict_to_view:
+            reaction_ids = list(view_cache.get(view_path).reaction_to_edges.keys())
+        elif reaction != None:
+            names = model_handler.get_reaction_names(reaction)
+            reaction_ids = list(names.values()) + [r for r in reaction if not r in names]
+    elif restrict_to_view:
+        raise HTTPException(status_code=400, detail="view_name is required for restrict_to_view")
+    elif reaction != None:
+        reaction_ids = reaction
+
+    if command != None:
+        for cmd in command:
+            model_handler.add_modification_command(cmd.split(ARGUMENT_DELIMITER))
+    try:
+        # The chunks of the reactions are run in the worker pool.
+        return FastJSONResponse(content=model_handler.do_FVA(reaction_ids, fraction_of_optimum, FVAProcesses))
+    except (KeyError, ValueError, IndexError) as e:
+        raise HTTPException(status_code=400, detail="Invalid command: {}".format(e))
+
+@app.post("/solve_batch/{model_name}/", responses={404: {'description': 'Model not found'}} )
+@profiled
+def solve_batch(model_name: str, request: SolveBatchRequest):
+    """ Solve many scenarios against one model in one request.
+
+    Request body:
+    ---
+    scenarios: list of scenarios. Each scenario is a list of commands, such as ["knockout-succ_p", "bound-q8_c-0-2"].
+    The format of the commands is the same as 'solve'.
+
+    view_name: If reactions in commands are specified by the edgeID of the view, specify the view.
+
+    objective_only: If true, only the objective values are returned.
+
+    The model is loaded once, and each scenario is applied and reverted in turn.
+    The results are returned in the input order. 
+    If a scenario can not be applied, its result is {"error": message}.
+    """
+    model_handler = load_model_handler(model_name)
+    if request.view_name != None:
+        model_handler.set_id_type( get_specified_view_path(request.view_name) )
+    scenarios = [[cmd.split(ARGUMENT_DELIMITER) for cmd in scenario] for scenario in request.scenarios]
+    results = worker_pool.run(model_handler.solve_scenarios, scenarios, request.objective_only)
+    return FastJSONResponse(content={"results": results})
+
+# Number of the scenarios solved at once by the batch job. The progress is updated after each chunk.
+JobChunkSize = 10
+
+def job_source_checksums(model_handler: ModelHandler):
+    """ Checksums of the model, the user model and the view files, so that a changed model gets a new job. """
+    paths = [model_handler.base_model_path, model_handler.model_path, model_handler.id_type]
+    return [source_checksum(path) if path != None else None for path in paths]
+
+@app.post("/jobs/solve/{model_name}/", responses={404: {'description': 'Model not found'}})
+def submit_solve_job(model_name: str, request: SolveJobRequest):
+    """ Submit 'solve' as a background job, and returns its job_id. 
+
+    Request body:
+    ---
+    command: list of commands. The format is the same as 'solve'.
+
+    view_name: If reactions in commands are specified by the edgeID of the view, specify the view.
+
+    The identical submissions share the same job. See 'jobs/{job_id}' for the status.
+    """
+    model_handler = load_model_handler(model_name)
+    if request.view_name != None:
+        model_handler.set_id_type( get_specified_view_path(request.view_name) )
+    for cmd in request.command:
+        model_handler.add_modification_command(cmd.split(ARGUMENT_DELIMITER))
+
+    def run(job):
+        return worker_pool.run(model_handler.do_FBA)
+    payload = [model_name, job_source_checksums(model_handler), request.command, request.view_name]
+    job = job_manager.submit("solve", payload, run)
+    return job.info()
+
+@app.post("/jobs/solve_batch/{model_name}/", responses={404: {'description': 'Model not found'}})
+def submit_solve_batch_job(model_name: str, request: SolveBatchRequest):
+    """ Submit 'solve_batch' as a background job, and returns its job_id. 
+
+    The request body is the same as 'solve_batch'. The progress is reported as the ratio of the solved scenarios,
+    and the cancelled job stops after the current chunk of the scenarios.
+    """
+    model_handler = load_model_handler(model_name)
+    if request.view_name != None:
+        model_handler.set_id_type( get_specified_view_path(request.view_name) )
+    scenarios = [[cmd.split(ARGUMENT_DELIMITER) for cmd in scenario] for scenario in request.scenarios]
+
+    def run(job):
+        results = []
+        for i in range(0, len(scenarios), JobChunkSize):
+            job.check_cancelled()
+            results += worker_pool.run(model_handler.solve_scenarios, scenarios[i:i + JobChunkSize], request.objective_only)
+            job.set_progress(len(results) / len(scenarios))
+        return {"results": results}
+    payload = [model_name, job_source_checksums(model_handler), request.scenarios, request.view_name, request.objective_only]
+    job = job_manager.submit("solve_batch", payload, run)
+    return job.info()
+
+@app.get("/jobs/{job_id}", responses={404: {'description': 'Job not found'}})
+def get_job_status(job_id: str):
+    """ Returns the status of the job: 'queued', 'running', 'done', 'failed' or 'cancelled', and its progress. """
+    job = job_manager.get(job_id)
+    if job == None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.info()
+
+@app.get("/jobs/{job_id}/result", responses={404: {'description': 'Job not found'}, 409: {'description': 'Job not finished'}})
+def get_job_result(job_id: str):
+    """ Returns the result of the finished job. The result is kept for a while after the job finished. """
+    job = job_manager.get(job_id)
+    if job == None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job.status == "failed":
+        raise HTTPException(status_code=500, detail=job.error)
+    if job.status != "done":
+        raise HTTPException(status_code=409, detail="Job is {}".format(job.status))
+    # Stored as JSON
+    return Response(content=job.result, media_type="application/json")
+
+@app.delete("/jobs/{job_id}", responses={404: {'description': 'Job not found'}})
+def cancel_job(job_id: str):
+    """ Cancel the job. """
+    job = job_manager.cancel(job_id)
+    if job == None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.info()
 
 @app.get("/save/{model_name}/{author}/{new_model_name}", responses={404: {'description': 'Model not found'}})
+@profiled
 def save(model_name: str, author: str, new_model_name: str, command: Union[List[str], None] = Query(None),  view_name : str = Query(None) ):
     """ Save user model. Saved models can be shown in by the 'open_user_model' API.
 
@@ -220,28 +530,14 @@ def save(model_name: str, author: str, new_model_name: str, command: Union[List[
     if len(author) == 0:
         raise HTTPException(status_code=500, detail='Both the commands and author must be specified')
     if new_model_name in object_manager.list_user_models():
-        raise HTTPException(status_code=500, detail='The name {new_model_name} already exists'.format(new_model_name))
-
-    # First, Check the requested model either base_model or user_model
-    model_type = object_manager.check_model_type(model_name)
+        raise HTTPException(status_code=500, detail='The name {} already exists'.format(new_model_name))
 
     # Then, load therequested model.
-    model_handler = ModelHandler() 
-    if model_type == "base_model" :
-        model_path = object_manager.model_property(model_name)["path"]
-        model_handler.set_base_model(model_name, model_path)
-    elif model_type == "user_model":
-        model_path = object_manager.user_model_property(model_name)["path"]
-        model_handler.load_user_model(model_path)
-    else:
-        raise HTTPException(status_code=404, detail="Model not found")
+    model_handler = load_model_handler(model_name)
 
     # if the reactions in the argument 'commmands' are specified by the edgeID defined in the view,
-    # We have to generate the table.
-    edgeID_to_rxnID = None
+    # the table of the view converts them.
     if view_name != None:
-        #edgeID_to_rxnID = generate_edgeID_to_rxnID_map(view_name)
-        edgeID_to_rxnID = None 
         model_handler.set_id_type( get_specified_view_path(view_name) )
 
     if command != None:
@@ -250,15 +546,27 @@ def save(model_name: str, author: str, new_model_name: str, command: Union[List[
             print(tokens)
             model_handler.add_modification_command(tokens)
     
+    # Check all the commands can be applied to the model, and compile them into the final bounds.
+    try:
+        compiled = worker_pool.run(model_handler.compile_modifications)
+    except (KeyError, ValueError, IndexError) as e:
+        raise HTTPException(status_code=400, detail="Invalid command: {}".format(e))
+
     new_model_file_basename = "{}.yaml".format(new_model_name)
     new_model_file_path = os.path.join(DataDir, new_model_file_basename )
     model_handler.set_author(author)
     model_handler.set_model_name(new_model_name)
-    model_handler.save_user_model(new_model_file_path)
+    model_handler.save_user_model(new_model_file_path, compiled)
+    try:
+        # The user model is served in JSON by 'open_user_model'. Prepare it and its compressed variants now.
+        http_cache.prepare_user_model_variants(new_model_file_path)
+    except OSError as e:
+        print("failed to compress {}: {}".format(new_model_file_path, e))
     object_manager.register_model(new_model_name, new_model_file_path, model_handler.get_base_model_name(), model_name )
     return {"new_model_name" : new_model_name}
 
 @app.get("/metabolite_information/{model_name}/{metabolite_id}")
+@profiled
 def get_metabolite_info(model_name: str, metabolite_id: str, view_name: str = Query(None) ):
     """Get the information of the metabolite. 
 
@@ -272,23 +580,14 @@ def get_metabolite_info(model_name: str, metabolite_id: str, view_name: str = Qu
 
     view_name: If the view file (such as iJO1366) is set, the 'metabolite_id' parameter can be set with the index of the metabolite instead of its name.
     """
-    model_type = object_manager.check_model_type(model_name)
-    model_handler = ModelHandler() 
-    if model_type == "base_model" :
-        model_path = object_manager.model_property(model_name)["path"]
-        model_handler.set_base_model(model_name, model_path)
-    elif model_type == "user_model":
-        model_path = object_manager.user_model_property(model_name)["path"]
-        model_handler.load_user_model(model_path)
-    else:
-        raise HTTPException(status_code=404, detail="Model not found")
+    model_handler = load_model_handler(model_name)
     if view_name != None:
         model_handler.set_id_type( get_specified_view_path(view_name) )
     model_property = object_manager.model_property(model_name)
     if model_property is not None:
         if "metabolites_db" in model_property:
             metabolite_db = model_property["metabolites_db"]
-            metabolite_info = model_handler.get_metabolite_information(metabolite_db, metabolite_id)
+            metabolite_info = worker_pool.run(model_handler.get_metabolite_information, metabolite_db, metabolite_id)
             if metabolite_info != {}:
                 return {"metabolite_information": metabolite_info }
             else:
@@ -299,6 +598,7 @@ def get_metabolite_info(model_name: str, metabolite_id: str, view_name: str = Qu
 
 
 @app.get("/reaction_information/{model_name}/{reaction_id}")
+@profiled
 def get_reaction_info(model_name: str, reaction_id: str, 
         db_src: str = Query(None), view_name: str = Query(None)):
     """Get the information of the reaction. db_src can be set 'bigg' or 'metanetx'.
@@ -315,16 +615,7 @@ def get_reaction_info(model_name: str, reaction_id: str,
     """
 
     import information
-    model_type = object_manager.check_model_type(model_name)
-    model_handler = ModelHandler() 
-    if model_type == "base_model" :
-        model_path = object_manager.model_property(model_name)["path"]
-        model_handler.set_base_model(model_name, model_path)
-    elif model_type == "user_model":
-        model_path = object_manager.user_model_property(model_name)["path"]
-        model_handler.load_user_model(model_path)
-    else:
-        raise HTTPException(status_code=404, detail="Model not found")
+    model_handler = load_model_handler(model_name)
 
     # First, get the name of the reaction from the model file.
     if view_name != None:
@@ -341,9 +632,7 @@ def get_reaction_info(model_name: str, reaction_id: str,
     if db_src == None:
         db_src = model_db_type  # default value
 
-    db_table = {
-        "bigg" : "bigg.reaction", "metanetx" : "metanetx.reaction",
-    }
+    db_table = information.reaction_db_table
     if model_db_type in db_table:   
         # ex) bigg => bigg.reaction
         model_db_type = db_table[model_db_type]
@@ -360,21 +649,166 @@ def get_reaction_info(model_name: str, reaction_id: str,
 
     ret = None
     if reaction_id != None:
-        ret = information.get_reaction_information(reaction_id, db_src)
+        ret = worker_pool.run(information.get_reaction_information, reaction_id, db_src)
     if ret != None:
         return { "reaction_information": ret }
     else:
         raise HTTPException(status_code=404, detail="Reaction {} not found at {}".format(reaction_id, db_src))
 
 
+@app.post("/metabolite_information/{model_name}", responses={404: {'description': 'Model not found'}})
+@profiled
+def get_metabolite_info_batch(model_name: str, request: AnnotationRequest):
+    """Get the information of many metabolites in one request.
+
+    Request body:
+    ---
+    ids: list of metabolite names such as nadh_c, or the node IDs of the view if 'view_name' is set.
+
+    view_name: the view which defines the node IDs.
+
+    Returns the information of the found metabolites, and the IDs not found in 'not_found'.
+    """
+    model_handler = load_model_handler(model_name)
+    if request.view_name != None:
+        model_handler.set_id_type( get_specified_view_path(request.view_name) )
+    model_property = object_manager.model_property(model_handler.get_base_model_name())
+    if model_property == None or not "metabolites_db" in model_property:
+        raise HTTPException(status_code=404, detail="Model DB not found")
+
+    results = worker_pool.run(model_handler.get_metabolite_information_many, model_property["metabolites_db"], request.ids)
+    not_found = [mid for mid in request.ids if not mid in results]
+    return {"metabolite_information": results, "not_found": not_found}
+
+@app.post("/reaction_information/{model_name}", responses={404: {'description': 'Model not found'}})
+@profiled
+def get_reaction_info_batch(model_name: str, request: AnnotationRequest):
+    """Get the information of many reactions in one request.
+
+    Request body:
+    ---
+    ids: list of reaction names such as MDH, or the edge IDs of the view if 'view_name' is set.
+
+    db_src: database source. Currently, 'bigg' or 'metanetx' can be set.
+
+    view_name: the view which defines the edge IDs.
+
+    Returns the information of the found reactions, and the IDs not found in 'not_found'.
+    """
+    import information
+    model_handler = load_model_handler(model_name)
+    if request.view_name != None:
+        model_handler.set_id_type( get_specified_view_path(request.view_name) )
+    # {requested id: reaction name in the model}
+    names = model_handler.get_reaction_names(request.ids)
+
+    model_property = object_manager.model_property(model_handler.get_base_model_name())
+    db_table = information.reaction_db_table
+    if model_property == None or not model_property.get("database_type") in db_table:
+        raise HTTPException(status_code=404, detail="Model DB not found")
+    model_db_type = db_table[model_property["database_type"]]
+    db_src = request.db_src if request.db_src != None else model_property["database_type"]
+    if db_src in db_table:
+        db_src = db_table[db_src]
+    else:
+        raise HTTPException(status_code=404, detail="Specified DB not found")
+
+    if model_db_type != db_src:
+        converted = information.convert_names(model_db_type, set(names.values()), db_src)
+        names = {rid: converted[name][0] for rid, name in names.items() if 0 < len(converted[name])}
+
+    infos = worker_pool.run(information.get_reaction_information_many, list(names.values()), db_src)
+    results = {rid: infos[name] for rid, name in names.items() if name in infos}
+    not_found = [rid for rid in request.ids if not rid in results]
+    return {"reaction_information": results, "not_found": not_found}
+
+@app.get("/convert_ids/{model_name}", responses={404: {'description': 'Model not found'}})
+@profiled
+def convert_model_ids(model_name: str, target_db: str, id_type: str = Query("reaction")):
+    """Convert all the reaction (or metabolite) IDs of the model to the other database in one call.
+
+    Parameters:
+    ---
+    model_name: model name, such as iJO1366. Both base_model and user_defined_model can be specified.
+
+    target_db: target database, such as 'metanetx'. The namespace such as 'metanetx.reaction' can be also specified.
+
+    id_type: 'reaction' or 'metabolite'.
+
+    The IDs which can not be converted are listed in 'unmapped'.
+    One ID can be mapped to multiple IDs.
+    """
+    import information
+    model_handler = load_model_handler(model_name)
+    model_property = object_manager.model_property(model_handler.get_base_model_name())
+    if model_property == None or not "database_type" in model_property:
+        raise HTTPException(status_code=404, detail="Model DB not found")
+
+    if id_type == "reaction":
+        db_table = information.reaction_db_table
+        src_ids = worker_pool.run(model_handler.list_reaction_ids)
+    elif id_type == "metabolite":
+        db_table = information.metabolite_db_table
+        src_ids = worker_pool.run(model_handler.list_metabolite_ids)
+    else:
+        raise HTTPException(status_code=400, detail="id_type must be 'reaction' or 'metabolite'")
+
+    src_db = db_table.get(model_property["database_type"])
+    dst_db = db_table.get(target_db, target_db)
+    if src_db == None or not dst_db in db_table.values():
+        raise HTTPException(status_code=404, detail="Specified DB not found")
+
+    mapping = information.convert_names(src_db, src_ids, dst_db)
+    unmapped = [src_id for src_id in src_ids if len(mapping[src_id]) == 0]
+    for src_id in unmapped:
+        del mapping[src_id]
+    return FastJSONResponse(content={"src_db": src_db, "dst_db": dst_db, "mapping": mapping, "unmapped": unmapped})
+
 @app.get("/modules")
-def get_module_information():
-    return {"modules": ["FBA"]}
+async def get_module_information():
+    return {"modules": ["FBA", "FVA"]}
+
+@app.get("/cache_stats")
+async def get_cache_stats():
+    """Returns the hit/miss counters of the caches."""
+    return {
+        "model_cache": model_cache.stats(),
+        "view_cache": view_cache.stats(),
+        "solution_cache": solution_cache.stats(),
+    }
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Returns the metrics in the Prometheus text format.
+
+    The request latencies by route, the stage timings (model_load, view_map, modify, optimize, fva, format, encode, worker_pool),
+    the solver statuses, the cache hit ratios and the requests, tasks and jobs in flight.
+    The values are of this server process; the timings of the worker processes are merged into the requests.
+    """
+    cache_stats = {"model": model_cache.stats(), "view": view_cache.stats(), "solution": solution_cache.stats()}
+    hits = {}
+    misses = {}
+    ratios = {}
+    for name, stats in cache_stats.items():
+        hits[(name,)] = stats["hits"] + stats.get("disk_hits", 0)
+        misses[(name,)] = stats["misses"]
+        total = hits[(name,)] + misses[(name,)]
+        ratios[(name,)] = (hits[(name,)] / total) if 0 < total else 0.0
+    # SQLite may wait for the lock held by the other processes. Do not block the event loop.
+    job_counts = await run_io(job_manager.status_counts)
+    jobs = {(status,): count for status, count in job_counts.items()}
+    return metrics.render(
+        metrics.render_values("kosmogora_cache_hits_total", "Number of the cache hits.", ("cache",), hits, "counter"),
+        metrics.render_values("kosmogora_cache_misses_total", "Number of the cache misses.", ("cache",), misses, "counter"),
+        metrics.render_values("kosmogora_cache_hit_ratio", "Ratio of the cache hits.", ("cache",), ratios),
+        metrics.render_values("kosmogora_worker_pool_tasks_in_flight", "Number of the tasks submitted to the worker pool and not finished.",
+            (), {(): worker_pool.pending}),
+        metrics.render_values("kosmogora_jobs", "Number of the jobs by status.", ("status",), jobs),
+    )
 
 @app.get("/apis/")
-def get_api_information(api_id: str = Query(None)):
+async def get_api_information(api_id: str = Query(None)):
     import api_definition
-    import json
     if api_id == None:
         api_list = [
             "list_models", 
@@ -389,15 +823,19 @@ def get_api_information(api_id: str = Query(None)):
             "open_user_model",
             "list_reaction_id",
             "solve",
+            "solve_batch",
+            "fva",
+            "reaction_index",
+            "jobs",
             "save",
             "metabolite_information",
             "reaction_information",
+            "convert_ids",
+            "metrics",
         ]
-        s = {"apis" : api_list} 
-        return JSONResponse(content = s)
+        return {"apis" : api_list}
     else:
         if api_id in api_definition.schema:
-            s = json.dumps( api_definition.schema[api_id] )
-            return JSONResponse(content = s)
+            return api_definition.schema[api_id]
         else:
-            return None
+            raise HTTPException(status_code=404, detail="API not found")
@@ -0,0 +1,91 @@
+import os
+import sys
+import pickle
+import hashlib
+import threading
+import cobra
+import cobra.io
+
+# Bump this when the layout of the compiled file changes.
+CompiledFormatVersion = 1
+CompiledSuffix = ".kmodel"
+
+_checksum_lock = threading.Lock()
+_checksum_table = {}
+
+def compiled_path(sbml_path: str) -> str:
+    """ The compiled model is stored next to the source SBML file. """
+    return sbml_path + CompiledSuffix
+
+def source_checksum(path: str) -> str:
+    """ sha256 of the file. It is recomputed only when the mtime or the size changes. """
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    signature = (st.st_mtime_ns, st.st_size)
+    with _checksum_lock:
+        cached = _checksum_table.get(path)
+        if cached != None and cached[0] == signature:
+            return cached[1]
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    checksum = h.hexdigest()
+    with _checksum_lock:
+        _checksum_table[path] = (signature, checksum)
+    return checksum
+
+def _header(sbml_path: str):
+    return {
+        "format_version": CompiledFormatVersion,
+        "cobra_version": cobra.__version__,
+        "source_sha256": source_checksum(sbml_path),
+    }
+
+def compile_model(sbml_path: str, model = None) -> str:
+    """ Parse the SBML file and store the pickled cobra.Model next to it.
+
+    The file consists of two pickles: the header (versions and the checksum of the source)
+    and the model itself, so that the validity can be checked without loading the model.
+    """
+    if model == None:
+        model = cobra.io.read_sbml_model(sbml_path)
+    header = _header(sbml_path)
+    dst_path = compiled_path(sbml_path)
+    tmp_path = "{}.{}.tmp".format(dst_path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump(model, f, protocol=pickle.HIGHEST_PROTOCOL)
+    # Rename atomically, not to expose the half-written file to other workers.
+    os.replace(tmp_path, dst_path)
+    return dst_path
+
+def load_compiled_model(sbml_path: str):
+    """ Returns the compiled model, or None if it does not exist or is out of date. """
+    path = compiled_path(sbml_path)
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            header = pickle.load(f)
+            if header != _header(sbml_path):
+                print("{} is out of date.".format(path))
+                return None
+            return pickle.load(f)
+    except Exception as e:
+        print("Failed to load {}: {}".format(path, e))
+        return None
+
+def load_model(sbml_path: str):
+    """ Load the model from the compiled form if it is valid, otherwise from the SBML file. """
+    model = load_compiled_model(sbml_path)
+    if model == None:
+        model = cobra.io.read_sbml_model(sbml_path)
+    return model
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Usage: python compiled_model.py model1.xml [model2.xml ...]")
+    for sbml_path in sys.argv[1:]:
+        print("compiled: {}".format(compile_model(sbml_path)))
@@ -0,0 +1,96 @@
+import json
+import datetime
+from fastapi.responses import JSONResponse, StreamingResponse
+import metrics
+
+try:
+    import orjson
+except ImportError:
+    # Fall back to the standard json module (slower).
+    orjson = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+def _default(obj):
+    """ Convert the objects which the encoder does not know, such as NumPy arrays and pandas Series. """
+    if np != None:
+        if isinstance(obj, np.generic):
+            return obj.item()
+        if isinstance(obj, np.ndarray):
+            return obj.tolist()
+    if hasattr(obj, "tolist"):
+        # pandas Series and Index
+        return obj.tolist()
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    if isinstance(obj, (datetime.date, datetime.datetime)):
+        return obj.isoformat()
+    raise TypeError("Object of type {} is not JSON serializable".format(type(obj).__name__))
+
+if orjson != None:
+    _orjson_options = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+    def dumps(content) -> bytes:
+        """ Encode the content into JSON. NaN and Infinity are encoded as null. """
+        return orjson.dumps(content, default=_default, option=_orjson_options)
+else:
+    def _replace_nan(obj):
+        if isinstance(obj, float) and (obj != obj or obj in (float("inf"), float("-inf"))):
+            return None
+        if isinstance(obj, dict):
+            return {k: _replace_nan(v) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return [_replace_nan(v) for v in obj]
+        return obj
+
+    def dumps(content) -> bytes:
+        """ Encode the content into JSON. NaN and Infinity are encoded as null. """
+        try:
+            return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":"), default=_default).encode("utf-8")
+        except ValueError:
+            # Same output as orjson. Only the (rare) content with NaN pays for the conversion.
+            return json.dumps(_replace_nan(content), ensure_ascii=False, separators=(",", ":"), default=_default).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """ JSONResponse encoded by orjson if available. NumPy and pandas values are encoded as they are.
+
+    The encoding is measured as the stage 'encode'. (see metrics.py)
+    Return it from the endpoint directly to skip jsonable_encoder(), which walks every element of the content.
+    """
+    def render(self, content) -> bytes:
+        with metrics.stage("encode"):
+            return dumps(content)
+
+
+def stream_json_object(items, chunk_size: int = 1000):
+    """ Yields the JSON object of the items [(key, value), ...] in chunks.
+
+    If the value is a generator, it is encoded as an array, chunk_size elements at a time,
+    so that the whole array is never built in memory.
+    """
+    yield b"{"
+    for i, (key, value) in enumerate(items):
+        yield (b"," if 0 < i else b"") + dumps(key) + b":"
+        if not hasattr(value, "__next__"):
+            yield dumps(value)
+            continue
+        yield b"["
+        first = True
+        chunk = []
+        for element in value:
+            chunk.append(element)
+            if chunk_size <= len(chunk):
+                yield (b"" if first else b",") + dumps(chunk)[1:-1]
+                first = False
+                chunk = []
+        if 0 < len(chunk):
+            yield (b"" if first else b",") + dumps(chunk)[1:-1]
+        yield b"]"
+    yield b"}"
+
+def streaming_json_response(items, chunk_size: int = 1000, **kwargs) -> StreamingResponse:
+    return StreamingResponse(stream_json_object(items, chunk_size), media_type="application/json", **kwargs)
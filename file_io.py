@@ -0,0 +1,18 @@
+import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+# Blocking file operations of the async endpoints are run in this dedicated pool,
+# so that they do not compete with the sync endpoints (such as solve) for the threadpool of the server.
+# The size can be set by the environment variable KOSMOGORA_IO_THREADS.
+io_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("KOSMOGORA_IO_THREADS", 8)), thread_name_prefix="kosmogora-io")
+
+async def run_io(fn, *args):
+    """ Run the blocking function in the I/O pool without blocking the event loop. """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(io_executor, fn, *args)
+
+def load_yaml_file(path: str):
+    import yaml
+    with open(path, 'r') as f:
+        return yaml.safe_load(f)
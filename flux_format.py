@@ -0,0 +1,75 @@
+import io
+import numpy as np
+from fastapi.responses import Response
+
+# Formats of the fluxes returned by /solve
+#   pairs:    [[reaction_id, flux], ...] (default)
+#   sparse:   same as 'pairs', but the fluxes whose absolute values are not greater than the tolerance are omitted.
+#   columnar: flat list of the fluxes, ordered by the reaction index (see /reaction_index).
+#   npy:      same as 'columnar', but encoded by numpy.save(). The objective value is in the X-Objective-Value header.
+FluxFormats = ("pairs", "sparse", "columnar", "npy")
+
+def reaction_index(reaction_ids):
+    """ The stable order of the reactions used by the columnar formats. """
+    return sorted(reaction_ids)
+
+def format_solution(data, flux_format: str = "pairs", tolerance: float = 0.0, version: str = None):
+    """ Convert the result of ModelHandler.do_FBA() to the requested format.
+
+    'data["fluxes"]' is sorted by the reaction ID, which is the same order as reaction_index().
+    'version' identifies the reaction index, and is returned with the columnar formats.
+    """
+    if flux_format == "pairs":
+        return data
+    elif flux_format == "sparse":
+        return {
+            "fluxes": [kv for kv in data["fluxes"] if tolerance < abs(kv[1])],
+            "objective_value": data["objective_value"],
+            "tolerance": tolerance,
+        }
+    elif flux_format == "columnar":
+        return {
+            "version": version,
+            "fluxes": [v for (_, v) in data["fluxes"]],
+            "objective_value": data["objective_value"],
+        }
+    elif flux_format == "npy":
+        buf = io.BytesIO()
+        np.save(buf, np.fromiter((v for (_, v) in data["fluxes"]), dtype=np.float64, count=len(data["fluxes"])))
+        headers = {
+            "X-Objective-Value": repr(data["objective_value"]),
+            "X-Reaction-Index-Version": str(version),
+        }
+        return Response(content=buf.getvalue(), media_type="application/octet-stream", headers=headers)
+    else:
+        raise ValueError("Unknown format: {}".format(flux_format))
+
+def stream_solution(data, flux_format: str = "pairs", tolerance: float = 0.0, version: str = None):
+    """ Same as format_solution(), but returns [(key, value), ...] for fast_json.stream_json_object().
+    The fluxes are generated lazily, instead of building the list of the format. 'npy' is not supported. """
+    fluxes = data["fluxes"]
+    if flux_format == "pairs":
+        return [("objective_value", data["objective_value"]), ("fluxes", (kv for kv in fluxes))]
+    elif flux_format == "sparse":
+        return [("objective_value", data["objective_value"]), ("tolerance", tolerance),
+                ("fluxes", (kv for kv in fluxes if tolerance < abs(kv[1])))]
+    elif flux_format == "columnar":
+        return [("version", version), ("objective_value", data["objective_value"]),
+                ("fluxes", (v for (_, v) in fluxes))]
+    else:
+        raise ValueError("Format {} can not be streamed".format(flux_format))
+
+def flux_delta(data, reference, threshold: float = 0.0):
+    """ Returns the reactions whose fluxes differ from the reference solution by more than the threshold. """
+    reference_fluxes = dict(reference["fluxes"])
+    changed = []
+    for reaction_id, flux in data["fluxes"]:
+        reference_flux = reference_fluxes.get(reaction_id, 0.0)
+        if threshold < abs(flux - reference_flux):
+            changed.append( [reaction_id, reference_flux, flux] )
+    return {
+        "objective_value": data["objective_value"],
+        "reference_objective_value": reference["objective_value"],
+        "threshold": threshold,
+        "changed": changed,
+    }
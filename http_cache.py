@@ -0,0 +1,252 @@
+import os
+import gzip
+import hashlib
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Optional, Dict
+from fastapi import Response
+from fastapi.responses import StreamingResponse
+
+from compiled_model import source_checksum
+from file_io import run_io, load_yaml_file
+import fast_json
+
+try:
+    import brotli
+except ImportError:
+    # Only gzip variants are generated.
+    brotli = None
+
+# Compressed variants of the static-ish files, in the order of preference.
+# Each variant is written next to the file (e.g. iJO1366.xml.gz) with the same mtime as the file,
+# which tells that the variant is up to date.
+Encodings = [("gzip", ".gz")]
+if brotli != None:
+    Encodings.insert(0, ("br", ".br"))
+# The saved user models are served as JSON. The JSON is written next to the YAML file.
+JsonSuffix = ".json"
+# Files smaller than this are not worth compressing.
+MinimumCompressSize = 1024
+# Size of each read of the streamed file.
+StreamChunkSize = 64 * 1024
+
+def _compress(encoding: str, data: bytes) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality=11)
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+def _write_atomically(path: str, data: bytes, mtime_ns: int):
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.utime(tmp_path, ns=(mtime_ns, mtime_ns))
+    os.replace(tmp_path, path)
+
+# The saved user models whose JSON form could not be written. (see user_model_response())
+_unwritable_paths = set()
+
+def _is_fresh(variant_path: str, st: os.stat_result) -> bool:
+    try:
+        return os.stat(variant_path).st_mtime_ns == st.st_mtime_ns
+    except OSError:
+        return False
+
+def prepare_variants(path: str):
+    """ Write the compressed variants of the file, unless they are up to date. """
+    st = os.stat(path)
+    if st.st_size < MinimumCompressSize:
+        return
+    data = None
+    for encoding, suffix in Encodings:
+        if _is_fresh(path + suffix, st):
+            continue
+        if data == None:
+            with open(path, "rb") as f:
+                data = f.read()
+        _write_atomically(path + suffix, _compress(encoding, data), st.st_mtime_ns)
+
+def prepare_user_model_variants(yaml_path: str):
+    """ Write the JSON form of the saved user model and its compressed variants. """
+    st = os.stat(yaml_path)
+    json_path = yaml_path + JsonSuffix
+    if not _is_fresh(json_path, st):
+        _write_atomically(json_path, fast_json.dumps(load_yaml_file(yaml_path)), st.st_mtime_ns)
+    prepare_variants(json_path)
+
+def make_etag(checksum: str, encoding: Optional[str] = None) -> str:
+    """ Strong ETag. Each encoding is a different representation, so it has its own tag. """
+    if encoding == None:
+        return '"{}"'.format(checksum[:32])
+    return '"{}-{}"'.format(checksum[:32], encoding)
+
+def http_date(mtime: float) -> str:
+    return formatdate(mtime, usegmt=True)
+
+def is_not_modified(request_headers, etag: str, mtime: Optional[float]) -> bool:
+    """ Evaluate If-None-Match, or If-Modified-Since if If-None-Match is not given. """
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match != None:
+        if if_none_match.strip() == "*":
+            return True
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        # The weak comparison is used for GET.
+        return etag in [tag[2:] if tag.startswith("W/") else tag for tag in tags]
+    if_modified_since = request_headers.get("if-modified-since")
+    if if_modified_since != None and mtime != None:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def select_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """ Returns the most preferred encoding of Encodings accepted by the client, or None for identity. """
+    if accept_encoding == None:
+        return None
+    accepted = {}
+    for item in accept_encoding.split(","):
+        tokens = item.strip().split(";")
+        q = 1.0
+        for param in tokens[1:]:
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[tokens[0].strip().lower()] = q
+    for encoding, _ in Encodings:
+        if 0 < accepted.get(encoding, accepted.get("*", 0)):
+            return encoding
+    return None
+
+def _not_modified(headers: Dict[str, str]) -> Response:
+    return Response(status_code=304, headers=headers)
+
+def parse_range(range_header: str, size: int):
+    """ Returns (first, last) byte of the single range 'bytes=first-last', 'bytes=first-' or 'bytes=-suffix',
+    'unsatisfiable' if it is out of the file, or None to serve the whole file (malformed or multiple ranges). """
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if first == "":
+            suffix = int(last)
+            if suffix <= 0:
+                return "unsatisfiable"
+            return max(0, size - suffix), size - 1
+        first = int(first)
+        last = size - 1 if last == "" else min(int(last), size - 1)
+    except ValueError:
+        return None
+    if size <= first:
+        return "unsatisfiable"
+    if last < first:
+        return None
+    return first, last
+
+def _if_range_matches(request_headers, etag: str, mtime: float) -> bool:
+    if_range = request_headers.get("if-range")
+    if if_range == None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"'):
+        return if_range == etag
+    return if_range == http_date(mtime)
+
+async def _read_file(path: str, first: int, length: int):
+    """ Yields the bytes of the file. Each read is run in the I/O pool (see file_io.py),
+    so that the downloads do not wait for the threadpool of the sync endpoints. """
+    f = await run_io(open, path, "rb")
+    try:
+        await run_io(f.seek, first)
+        while 0 < length:
+            chunk = await run_io(f.read, min(StreamChunkSize, length))
+            if len(chunk) == 0:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        await run_io(f.close)
+
+def stream_file(request_headers, path: str, st: os.stat_result, media_type: str, headers: Dict[str, str]) -> Response:
+    """ Streams the file (or the requested range of it) through the I/O pool. """
+    headers = dict(headers, **{"Accept-Ranges": "bytes"})
+    first, last = 0, st.st_size - 1
+    status_code = 200
+    range_header = request_headers.get("range")
+    if range_header != None and _if_range_matches(request_headers, headers["ETag"], st.st_mtime):
+        byte_range = parse_range(range_header, st.st_size)
+        if byte_range == "unsatisfiable":
+            headers["Content-Range"] = "bytes */{}".format(st.st_size)
+            return Response(status_code=416, headers=headers)
+        if byte_range != None:
+            first, last = byte_range
+            headers["Content-Range"] = "bytes {}-{}/{}".format(first, last, st.st_size)
+            status_code = 206
+    headers["Content-Length"] = str(last - first + 1)
+    return StreamingResponse(_read_file(path, first, last - first + 1), status_code=status_code,
+            media_type=media_type, headers=headers)
+
+def file_response(request_headers, path: str, media_type: str) -> Response:
+    """ Returns the file, its compressed variant chosen by Accept-Encoding, or 304 if the client has it.
+
+    It blocks (stat and checksum), so run it in the I/O pool. The body is read through the I/O pool too (see stream_file()).
+    The variants are written at the registration (obj_manager.initialize() and 'save'), never here;
+    if the variant is missing or out of date, the file is served as it is.
+    """
+    st = os.stat(path)
+    checksum = source_checksum(path)
+    encoding = select_encoding(request_headers.get("accept-encoding"))
+    if request_headers.get("range") != None:
+        # The ranges are of the file as it is. The clients can not decode a part of the compressed stream.
+        encoding = None
+    served_path = path
+    if encoding != None:
+        suffix = dict(Encodings)[encoding]
+        if _is_fresh(path + suffix, st):
+            served_path = path + suffix
+        else:
+            encoding = None
+    headers = {
+        "ETag": make_etag(checksum, encoding),
+        "Last-Modified": http_date(st.st_mtime),
+        "Vary": "Accept-Encoding",
+        "Cache-Control": "no-cache",
+    }
+    if is_not_modified(request_headers, headers["ETag"], st.st_mtime):
+        return _not_modified(headers)
+    if encoding != None:
+        headers["Content-Encoding"] = encoding
+        st = os.stat(served_path)
+    return stream_file(request_headers, served_path, st, media_type, headers)
+
+def user_model_response(request_headers, yaml_path: str) -> Response:
+    """ Same as file_response(), for the JSON form of the saved user model.
+
+    The JSON form is written at 'save'. For the models saved before it (or if it is out of date),
+    it is written once here. If it can not be written (e.g. read-only directory), the YAML file is
+    converted for each request, and the writing is not tried again.
+    """
+    json_path = yaml_path + JsonSuffix
+    st = os.stat(yaml_path)
+    if not _is_fresh(json_path, st):
+        if not yaml_path in _unwritable_paths:
+            try:
+                prepare_user_model_variants(yaml_path)
+            except OSError as e:
+                print("failed to write the JSON form of {}: {}".format(yaml_path, e))
+                _unwritable_paths.add(yaml_path)
+        if not _is_fresh(json_path, st):
+            return json_response(request_headers, load_yaml_file(yaml_path), st.st_mtime)
+    return file_response(request_headers, json_path, "application/json")
+
+def json_response(request_headers, content, mtime: Optional[float] = None) -> Response:
+    """ Returns the small JSON content with the ETag of its body, or 304 if the client has it. """
+    body = fast_json.dumps(content)
+    headers = {"ETag": make_etag(hashlib.sha256(body).hexdigest()), "Cache-Control": "no-cache"}
+    if mtime != None:
+        headers["Last-Modified"] = http_date(mtime)
+    if is_not_modified(request_headers, headers["ETag"], mtime):
+        return _not_modified(headers)
+    return Response(content=body, media_type="application/json", headers=headers)
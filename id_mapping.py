@@ -0,0 +1,80 @@
+import os
+import sys
+import threading
+from typing import Dict, List, Tuple, Iterable
+
+Id2IdDB = './models/id2id.tsv'
+
+class IdMapper:
+    """ Bidirectional index of the cross-database ID mapping (id2id.tsv).
+
+    Each line of the file is 'src_db, src_id, dst_db, dst_id' separated by TAB.
+    The index maps (db, id) to all the (db, id) related in either direction,
+    so one-to-many mappings are kept. It is loaded lazily on the first lookup,
+    and reloaded when the file changes.
+    Strings are interned and the values are stored as tuples to keep the index compact.
+    """
+    def __init__(self, db_path: str = Id2IdDB):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.signature = None
+        # {src_db: {src_id: ((dst_db, dst_id), ...)}}
+        self.index = {}
+
+    def _load(self):
+        index = {}
+        intern = sys.intern
+        def add(src_db, src_id, dst_db, dst_id):
+            table = index.get(src_db)
+            if table == None:
+                table = index[src_db] = {}
+            value = (dst_db, dst_id)
+            entries = table.get(src_id)
+            if entries == None:
+                table[src_id] = [value]
+            elif not value in entries:
+                entries.append(value)
+
+        with open(self.db_path) as f:
+            for line in f:
+                record = line.rstrip('\r\n').split('\t')
+                if len(record) < 4:
+                    continue
+                src_db, src_id, dst_db, dst_id = [intern(r) for r in record[:4]]
+                add(src_db, src_id, dst_db, dst_id)
+                add(dst_db, dst_id, src_db, src_id)
+        for table in index.values():
+            for key, entries in table.items():
+                table[key] = tuple(entries)
+        return index
+
+    def _get_index(self):
+        st = os.stat(self.db_path)
+        signature = (st.st_mtime_ns, st.st_size)
+        with self.lock:
+            if self.signature != signature:
+                print("load {}".format(self.db_path))
+                self.index = self._load()
+                self.signature = signature
+            return self.index
+
+    def load(self):
+        """ Load the index now, instead of on the first lookup. """
+        self._get_index()
+
+    def lookup(self, src_db: str, src_id: str) -> Tuple[Tuple[str, str], ...]:
+        """ Returns all (dst_db, dst_id) related to (src_db, src_id). """
+        return self._get_index().get(src_db, {}).get(src_id, ())
+
+    def convert(self, src_db: str, src_id: str, dst_db: str) -> List[str]:
+        return [dst_id for (db, dst_id) in self.lookup(src_db, src_id) if db == dst_db]
+
+    def convert_many(self, src_db: str, src_ids: Iterable[str], dst_db: str) -> Dict[str, List[str]]:
+        table = self._get_index().get(src_db, {})
+        ret = {}
+        for src_id in src_ids:
+            ret[src_id] = [dst_id for (db, dst_id) in table.get(src_id, ()) if db == dst_db]
+        return ret
+
+
+id_mapper = IdMapper()
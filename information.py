@@ -1,33 +1,15 @@
 import os
 import sys
+from annotation_store import get_store
+from id_mapping import id_mapper
 
-def get_reaction_information_bigg(reaction_id):
-    dbfilename = './models/bigg_models_reactions.txt'
-    column_names = None
-    data = None
-    ret = {}
-    with open(dbfilename) as f:
-        for line_num, line in enumerate(f):
-            record = line.rstrip('\n').split('\t')
-            if line_num == 0:
-                column_names = record
-            else:
-                if record[0] == reaction_id:
-                    data = record
-                    ret = {
-                            "ID": record[0],
-                            "NAME": record[1],
-                            "REACTION": record[2],
-                            "MODEL_LIST": record[3],
-                            "DATABASE_STRING": record[4],
-                            "OLD_BIGG_IDs": record[5]
-                    }
-                    break
-    return ret
+BiggReactionDB = './models/bigg_models_reactions.txt'
+MetaNetXReactionDB = "./models/reac_prop.tsv"
 
-def get_reaction_information_mtnx(reaction_id):
-    dbfilename = "./models/reac_prop.tsv"
-    ret = None
+def bigg_reaction_store():
+    return get_store(BiggReactionDB)
+
+def mtnx_reaction_store():
     '''
     Columns separated by TAB are as follows.
 
@@ -38,25 +20,39 @@ def get_reaction_information_mtnx(reaction_id):
     Is the equation balanced with respect to elemental composition and charge [BOOLEAN]
     Is this a transport reaction [BOOLEAN]
     '''
-    with open(dbfilename) as f:
-        print(reaction_id)
-        for line in f:
-            if line[0] == '#':
-                continue
-            record = line.rstrip('\n').split('\t')
-            if len(record) == 6:
-                if record[0] == reaction_id:
-                    # pack
-                    ret = {
-                            "ID": record[0],
-                            "REACTION": record[1],
-                            "REFERENCE": record[2],
-                            "ECs": record[3],
-                            "IS_BALANCED": record[4],
-                            "IS_TRNSPORT": record[5]
-                    }
-                    break
-    return ret
+    return get_store(MetaNetXReactionDB, has_header=False, comment_prefix='#', field_count=6)
+
+def _pack_reaction_bigg(record):
+    return {
+            "ID": record[0],
+            "NAME": record[1],
+            "REACTION": record[2],
+            "MODEL_LIST": record[3],
+            "DATABASE_STRING": record[4],
+            "OLD_BIGG_IDs": record[5]
+    }
+
+def _pack_reaction_mtnx(record):
+    return {
+            "ID": record[0],
+            "REACTION": record[1],
+            "REFERENCE": record[2],
+            "ECs": record[3],
+            "IS_BALANCED": record[4],
+            "IS_TRNSPORT": record[5]
+    }
+
+def get_reaction_information_bigg(reaction_id):
+    record = bigg_reaction_store().get(reaction_id)
+    if record == None:
+        return {}
+    return _pack_reaction_bigg(record)
+
+def get_reaction_information_mtnx(reaction_id):
+    record = mtnx_reaction_store().get(reaction_id)
+    if record == None:
+        return None
+    return _pack_reaction_mtnx(record)
 
 def get_reaction_information(reaction_id, db_src):
     if db_src == "metanetx" or db_src == "metanetx.reaction":
@@ -66,20 +62,37 @@ def get_reaction_information(reaction_id, db_src):
     else:
         return None
 
+def get_reaction_information_many(reaction_ids, db_src):
+    """ Returns {reaction_id: information} of the found reactions. """
+    if db_src == "metanetx" or db_src == "metanetx.reaction":
+        store, pack = mtnx_reaction_store(), _pack_reaction_mtnx
+    elif db_src == "bigg" or db_src == "bigg.reaction":
+        store, pack = bigg_reaction_store(), _pack_reaction_bigg
+    else:
+        return {}
+    return {key: pack(record) for key, record in store.get_many(reaction_ids).items()}
+
 def convert_name(src_db, src_id, dst_db):
-    db_file = './models/id2id.tsv'
-    ret = None
-    with open(db_file) as f:
-        for line in f:
-            record = line.rstrip().split('\t')
-            if record[0] == src_db and record[1] == src_id and record[2] == dst_db:
-                ret = record[3]
-                break
-    return ret
+    ret = id_mapper.convert(src_db, src_id, dst_db)
+    if len(ret) == 0:
+        return None
+    return ret[0]
+
+def convert_names(src_db, src_ids, dst_db):
+    """ Returns {src_id: [dst_id, ...]}. One ID can be mapped to multiple IDs. """
+    return id_mapper.convert_many(src_db, src_ids, dst_db)
 
 def available_reaction_db():
     return {"bigg", "metanetx"}
 
+# Namespaces used in id2id.tsv
+reaction_db_table = {
+    "bigg" : "bigg.reaction", "metanetx" : "metanetx.reaction",
+}
+metabolite_db_table = {
+    "bigg" : "bigg.metabolite", "metanetx" : "metanetx.chemical",
+}
+
 if __name__ == '__main__':
     name_mtx = convert_name("bigg.reaction", "EX_galside_cho_e", "metanetx.reaction") 
     if name_mtx == None:
@@ -0,0 +1,227 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+import fast_json
+
+# The jobs can be configured by the following environment variables.
+#   KOSMOGORA_JOB_THREADS: number of the jobs run at once (default: 2).
+#   KOSMOGORA_JOB_TTL:     seconds to keep the finished jobs and their results (default: 3600).
+#   KOSMOGORA_JOB_DB:      SQLite file of the jobs, shared by the server processes (default: ./data2/jobs.sqlite).
+DefaultJobThreads = 2
+DefaultJobTTL = 3600
+DefaultJobDB = "./data2/jobs.sqlite"
+
+ActiveStatuses = ("queued", "running")
+
+class JobCancelled(Exception):
+    pass
+
+class Job:
+    """ The job as it is stored. The result is the JSON-encoded bytes. """
+    def __init__(self, id: str, kind: str, key: str, status: str, progress: float, result: Optional[bytes],
+            error: Optional[str], created: float, started: Optional[float], finished: Optional[float]):
+        self.id = id
+        self.kind = kind
+        self.key = key
+        self.status = status    # queued, running, done, failed, cancelled
+        self.progress = progress
+        self.result = result
+        self.error = error
+        self.created = created
+        self.started = started
+        self.finished = finished
+
+    def info(self):
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "progress": self.progress,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+
+class RunningJob:
+    """ Passed to the job function, to report the progress and to check the cancellation. """
+    def __init__(self, manager, job_id: str):
+        self.manager = manager
+        self.id = job_id
+        self.cancel_event = threading.Event()
+        self.future = None
+
+    def set_progress(self, progress: float):
+        self.manager._execute("UPDATE jobs SET progress = ? WHERE id = ?", (progress, self.id))
+
+    def check_cancelled(self):
+        """ Called by the job function between the steps, to stop the cancelled job. """
+        if self.cancel_event.is_set() or self.manager._cancel_requested(self.id):
+            raise JobCancelled()
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class JobManager:
+    """ Runs the long analyses in the background.
+
+    The jobs are stored in a SQLite file, so that any server process (e.g. the other uvicorn worker)
+    can return the status and the result, and cancel the job. The job runs in the process which received it.
+    The submissions with the same key (e.g. the same model checksum and commands) share one job
+    while it is queued, running or its result is kept.
+    The finished jobs are removed after ttl seconds (by the next submit()).
+    The unfinished jobs of an exited process are reported as failed, and marked so by the next submit().
+    """
+    def __init__(self, threads: Optional[int] = None, ttl: Optional[float] = None, db_path: Optional[str] = None):
+        if threads == None:
+            threads = int(os.environ.get("KOSMOGORA_JOB_THREADS", DefaultJobThreads))
+        if ttl == None:
+            ttl = float(os.environ.get("KOSMOGORA_JOB_TTL", DefaultJobTTL))
+        if db_path == None:
+            db_path = os.environ.get("KOSMOGORA_JOB_DB", DefaultJobDB)
+        self.ttl = ttl
+        self.db_path = db_path
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="kosmogora-job")
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # {job ID: RunningJob} of the jobs run by this process.
+        self.running = {}
+
+    def _connection(self) -> sqlite3.Connection:
+        # One connection per thread (and per process, since the connection is keyed by the path and the pid).
+        key = (self.db_path, os.getpid())
+        if getattr(self.local, "key", None) != key:
+            os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+            connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY, kind TEXT, key TEXT, status TEXT, progress REAL, result BLOB, error TEXT,
+                created REAL, started REAL, finished REAL, owner INTEGER, cancel_requested INTEGER DEFAULT 0)""")
+            connection.execute("CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key)")
+            self.local.connection = connection
+            self.local.key = key
+        return self.local.connection
+
+    def _execute(self, sql: str, parameters=()) -> sqlite3.Cursor:
+        return self._connection().execute(sql, parameters)
+
+    def _cancel_requested(self, job_id: str) -> bool:
+        row = self._execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row != None and row[0] != 0
+
+    @staticmethod
+    def make_key(kind: str, payload) -> str:
+        return hashlib.sha256(json.dumps([kind, payload], sort_keys=True).encode()).hexdigest()
+
+    def _purge(self):
+        now = time.time()
+        self._execute("DELETE FROM jobs WHERE finished IS NOT NULL AND finished + ? < ?", (self.ttl, now))
+        for job_id, owner in self._execute("SELECT id, owner FROM jobs WHERE status IN (?, ?)", ActiveStatuses).fetchall():
+            if owner != os.getpid() and not _is_alive(owner):
+                self._execute("UPDATE jobs SET status = 'failed', error = ?, finished = ? WHERE id = ? AND status IN (?, ?)",
+                        ("The server process running the job exited", now, job_id) + ActiveStatuses)
+
+    def _select(self, where: str, parameters) -> Optional[Job]:
+        row = self._execute("SELECT id, kind, key, status, progress, result, error, created, started, finished "
+                "FROM jobs WHERE " + where, parameters).fetchone()
+        if row == None:
+            return None
+        return Job(*row)
+
+    def submit(self, kind: str, payload, fn) -> Job:
+        """ Submit fn(running_job) as a job, or returns the existing job of the same submission.
+
+        fn returns the result, which is encoded into JSON and stored.
+        """
+        key = self.make_key(kind, payload)
+        connection = self._connection()
+        # Serialize the submissions among the processes, not to start the same job twice.
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            self._purge()
+            job = self._select("key = ? AND status NOT IN ('failed', 'cancelled') ORDER BY created DESC", (key,))
+            if job != None:
+                connection.execute("COMMIT")
+                return job
+            job = Job(uuid.uuid4().hex, kind, key, "queued", 0.0, None, None, time.time(), None, None)
+            connection.execute("INSERT INTO jobs (id, kind, key, status, progress, created, owner) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (job.id, job.kind, job.key, job.status, job.progress, job.created, os.getpid()))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        running_job = RunningJob(self, job.id)
+        with self.lock:
+            self.running[job.id] = running_job
+        running_job.future = self.executor.submit(self._run, running_job, fn)
+        return job
+
+    def _run(self, running_job: RunningJob, fn):
+        try:
+            # Unless it was cancelled while queued.
+            cursor = self._execute("UPDATE jobs SET status = 'running', started = ? WHERE id = ? AND status = 'queued'",
+                    (time.time(), running_job.id))
+            if cursor.rowcount == 0:
+                return
+            status, result, error = "done", None, None
+            try:
+                running_job.check_cancelled()
+                result = fast_json.dumps(fn(running_job))
+            except JobCancelled:
+                status = "cancelled"
+            except Exception as e:
+                status, error = "failed", "{}: {}".format(type(e).__name__, e)
+            self._execute("UPDATE jobs SET status = ?, result = ?, error = ?, finished = ?, "
+                    "progress = CASE WHEN ? = 'done' THEN 1.0 ELSE progress END WHERE id = ?",
+                    (status, result, error, time.time(), status, running_job.id))
+        finally:
+            with self.lock:
+                self.running.pop(running_job.id, None)
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """ Returns the job, or None if it does not exist or is expired. It only reads; submit() purges. """
+        job = self._select("id = ? AND (finished IS NULL OR ? <= finished + ?)", (job_id, time.time(), self.ttl))
+        if job != None and job.status in ActiveStatuses:
+            owner = self._execute("SELECT owner FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if owner != None and owner[0] != os.getpid() and not _is_alive(owner[0]):
+                job.status = "failed"
+                job.error = "The server process running the job exited"
+        return job
+
+    def status_counts(self):
+        """ Returns {status: number of the jobs} of all the processes, except the expired ones. It only reads. """
+        return dict(self._execute("SELECT status, COUNT(*) FROM jobs WHERE finished IS NULL OR ? <= finished + ? GROUP BY status",
+                (time.time(), self.ttl)).fetchall())
+
+    def cancel(self, job_id: str) -> Optional[Job]:
+        """ The queued job is cancelled immediately. The running job stops at its next check_cancelled(). """
+        cursor = self._execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ?", (job_id,))
+        if cursor.rowcount == 0:
+            return None
+        self._execute("UPDATE jobs SET status = 'cancelled', finished = ? WHERE id = ? AND status = 'queued'",
+                (time.time(), job_id))
+        with self.lock:
+            running_job = self.running.get(job_id)
+        if running_job != None:
+            running_job.cancel_event.set()
+            if running_job.future != None and running_job.future.cancel():
+                with self.lock:
+                    self.running.pop(job_id, None)
+        return self.get(job_id)
+
+
+job_manager = JobManager()
@@ -0,0 +1,194 @@
+""" Launch the server with the preload-then-fork worker model.
+
+The parent process loads all the registered base models, the view tables and the annotation indexes once,
+then forks the workers. The workers share those pages with the parent by copy-on-write,
+so the memory does not grow linearly with the number of the workers.
+
+Usage: python launcher.py [--host 127.0.0.1] [--port 8000] [--workers 4] [--report-interval 0]
+
+The memory report (resident vs shared memory of each worker) is printed after the workers started,
+every 'report-interval' seconds if it is positive, and when the parent receives SIGUSR1.
+A worker which exits unexpectedly is replaced by a new one forked from the parent.
+"""
+import os
+import gc
+import sys
+import time
+import signal
+import socket
+import argparse
+
+def preload(object_manager):
+    """ Load everything the workers will share. """
+    from model_cache import model_cache
+    from view_cache import view_cache
+    from annotation_store import get_store
+    from id_mapping import id_mapper
+    import information
+
+    for model_name in object_manager.list_models():
+        model_property = object_manager.model_property(model_name)
+        try:
+            print("preload model: {}".format(model_name))
+            model_cache.get_entry(model_property["path"])
+        except Exception as e:
+            print("failed to preload {}: {}".format(model_name, e))
+        # The indexes are files, shared by the page cache. Build them here, not in each worker.
+        for key in ("reaction_db", "metabolites_db"):
+            if key in model_property and os.path.isfile(model_property[key]):
+                get_store(model_property[key]).build()
+
+    for view_name in object_manager.list_views():
+        try:
+            print("preload view: {}".format(view_name))
+            view_cache.get(object_manager.view_property(view_name)["path"])
+        except Exception as e:
+            print("failed to preload {}: {}".format(view_name, e))
+
+    for store_func in (information.bigg_reaction_store, information.mtnx_reaction_store):
+        store = store_func()
+        if os.path.isfile(store.db_path):
+            store.build()
+    if os.path.isfile(id_mapper.db_path):
+        id_mapper.load()
+
+def close_connections():
+    """ SQLite connections must not be carried over fork(). They are reopened in each worker. """
+    from annotation_store import close_all_stores
+    close_all_stores()
+
+def read_memory(pid: int):
+    """ Returns {field: kB} of /proc/<pid>/smaps_rollup (Linux only). """
+    ret = {}
+    with open("/proc/{}/smaps_rollup".format(pid)) as f:
+        for line in f:
+            tokens = line.split()
+            if len(tokens) == 3 and tokens[2] == "kB":
+                ret[tokens[0].rstrip(":")] = int(tokens[1])
+    return ret
+
+def memory_report(pids):
+    lines = ["{:>8} {:>10} {:>10} {:>10} {:>10}".format("pid", "rss(MB)", "pss(MB)", "shared(MB)", "private(MB)")]
+    for pid in pids:
+        try:
+            m = read_memory(pid)
+        except OSError:
+            continue
+        shared = m.get("Shared_Clean", 0) + m.get("Shared_Dirty", 0)
+        private = m.get("Private_Clean", 0) + m.get("Private_Dirty", 0)
+        lines.append("{:>8} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+            pid, m.get("Rss", 0) / 1024, m.get("Pss", 0) / 1024, shared / 1024, private / 1024))
+    return "\n".join(lines)
+
+def run_worker(sock, host: str, port: int):
+    import uvicorn
+    from app import app
+    config = uvicorn.Config(app, host=host, port=port)
+    uvicorn.Server(config).run(sockets=[sock])
+
+# A worker which exits sooner than this after its start is restarted after RestartDelay seconds,
+# not to fork in a tight loop when the workers can not start (e.g. the port is taken).
+MinimumWorkerLifetime = 10
+RestartDelay = 5
+
+def start_worker(sock, host: str, port: int) -> int:
+    """ Fork a worker from the preloaded parent. Returns its pid. """
+    pid = os.fork()
+    if pid == 0:
+        for signum in (signal.SIGUSR1, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, signal.SIG_DFL)
+        try:
+            run_worker(sock, host, port)
+        finally:
+            os._exit(0)
+    return pid
+
+def supervise(pids, started, start, stopping, report=None, report_interval: float = 0):
+    """ Wait for the workers, and replace the ones which exit unexpectedly.
+
+    pids: the pids of the workers. started: {pid: time.monotonic() when it started}. Both are updated.
+    start: forks a new worker and returns its pid.
+    stopping: set non-empty (by the signal handler) when shutting down; the exited workers are not replaced then.
+    Returns when all the workers exited.
+    """
+    next_report = time.monotonic() + report_interval
+    while pids:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid != 0:
+            pids.remove(pid)
+            lifetime = time.monotonic() - started.pop(pid)
+            if stopping:
+                continue
+            # Replace the worker which died (e.g. killed by the OOM killer), not to lose the capacity silently.
+            print("worker {} exited (status {}) after {:.0f} seconds".format(pid, os.waitstatus_to_exitcode(status), lifetime))
+            if lifetime < MinimumWorkerLifetime:
+                time.sleep(RestartDelay)
+                if stopping:
+                    continue
+            pid = start()
+            pids.append(pid)
+            started[pid] = time.monotonic()
+            print("started worker: {}".format(pid))
+            sys.stdout.flush()
+            continue
+        if report != None and 0 < report_interval and next_report <= time.monotonic():
+            report()
+            next_report = time.monotonic() + report_interval
+        time.sleep(0.5)
+
+def main():
+    parser = argparse.ArgumentParser(description="Launch Kosmogora with the preload-then-fork workers.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--report-interval", type=float, default=0)
+    args = parser.parse_args()
+
+    from app import object_manager
+    preload(object_manager)
+    close_connections()
+    # Objects created so far are never freed. Move them out of the GC,
+    # not to touch (and copy) their pages in the workers.
+    gc.collect()
+    gc.freeze()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((args.host, args.port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+
+    pids = []
+    # {pid: time.monotonic() when it started}
+    started = {}
+    for _ in range(args.workers):
+        pid = start_worker(sock, args.host, args.port)
+        pids.append(pid)
+        started[pid] = time.monotonic()
+    print("started workers: {}".format(pids))
+
+    stopping = []
+    def report(*_):
+        print(memory_report([os.getpid()] + pids))
+        sys.stdout.flush()
+    def terminate(signum, _):
+        stopping.append(signum)
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    signal.signal(signal.SIGUSR1, report)
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGINT, terminate)
+
+    time.sleep(3)
+    report()
+    supervise(pids, started, lambda: start_worker(sock, args.host, args.port), stopping, report, args.report_interval)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+import os
+import time
+import bisect
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Optional, Dict, Tuple
+
+# The timings can be configured by the following environment variable.
+#   KOSMOGORA_SERVER_TIMING: set 0 not to add the Server-Timing header to the responses (default: 1).
+ServerTimingEnabled = os.environ.get("KOSMOGORA_SERVER_TIMING", "1") != "0"
+
+# Upper bounds of the buckets of the histograms (seconds).
+DefaultBuckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _format_labels(label_names, labels, extra: str = "") -> str:
+    items = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+            for name, value in zip(label_names, labels)]
+    if extra != "":
+        items.append(extra)
+    if len(items) == 0:
+        return ""
+    return "{" + ",".join(items) + "}"
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+class Counter:
+    def __init__(self, name: str, help: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, labels: Tuple = (), amount: float = 1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self, type_name: str = "counter"):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, type_name)]
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append("{}{} {}".format(self.name, _format_labels(self.label_names, labels), _format_value(value)))
+        return lines
+
+class Gauge(Counter):
+    def dec(self, labels: Tuple = (), amount: float = 1):
+        self.inc(labels, -amount)
+
+    def set(self, labels: Tuple, value: float):
+        with self.lock:
+            self.values[labels] = value
+
+    def render(self):
+        return super().render("gauge")
+
+class Histogram:
+    def __init__(self, name: str, help: str, label_names: Tuple[str, ...] = (), buckets=DefaultBuckets):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        # {labels: [count of each bucket (not cumulative) + the overflow, sum]}
+        self.values = {}
+
+    def observe(self, labels: Tuple, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry == None:
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} histogram".format(self.name)]
+        with self.lock:
+            for labels, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    lines.append("{}_bucket{} {}".format(self.name,
+                        _format_labels(self.label_names, labels, 'le="{}"'.format(_format_value(bound))), cumulative))
+                lines.append("{}_sum{} {}".format(self.name, _format_labels(self.label_names, labels), _format_value(total)))
+                lines.append("{}_count{} {}".format(self.name, _format_labels(self.label_names, labels), cumulative))
+        return lines
+
+
+request_duration = Histogram("kosmogora_request_duration_seconds",
+        "Time to serve the request.", ("route", "method"))
+requests_total = Counter("kosmogora_requests_total",
+        "Number of the served requests.", ("route", "method", "status"))
+requests_in_flight = Gauge("kosmogora_requests_in_flight",
+        "Number of the requests being served.")
+stage_duration = Histogram("kosmogora_stage_duration_seconds",
+        "Time spent in each stage of the requests and the jobs.", ("stage",))
+solver_status_total = Counter("kosmogora_solver_status_total",
+        "Number of the solutions by the solver status.", ("status",))
+
+
+class Collector:
+    """ Stage timings and solver statuses of one request (or one task run in a worker process). """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # [(stage name, seconds), ...] in the order they finished.
+        self.stages = []
+        # {solver status: count}
+        self.statuses = {}
+
+    def export(self):
+        """ Picklable form, to be passed to merge() in the other process. """
+        with self.lock:
+            return {"stages": list(self.stages), "statuses": dict(self.statuses)}
+
+    def flush(self):
+        """ Record the collected values into the process-wide metrics. """
+        with self.lock:
+            for name, seconds in self.stages:
+                stage_duration.observe((name,), seconds)
+            for status, count in self.statuses.items():
+                solver_status_total.inc((status,), count)
+
+    def server_timing(self, total: Optional[float] = None) -> str:
+        """ Returns the value of the Server-Timing header. Stages of the same name are summed. """
+        durations = {}
+        with self.lock:
+            for name, seconds in self.stages:
+                durations[name] = durations.get(name, 0.0) + seconds
+        if total != None:
+            durations["total"] = total
+        return ", ".join("{};dur={:.3f}".format(name, seconds * 1000) for name, seconds in durations.items())
+
+_collector = contextvars.ContextVar("kosmogora_metrics_collector", default=None)
+
+def start_collector() -> Tuple[Collector, contextvars.Token]:
+    collector = Collector()
+    return collector, _collector.set(collector)
+
+def stop_collector(token: contextvars.Token):
+    _collector.reset(token)
+
+def record_stage(name: str, seconds: float):
+    """ Add the time to the current request, or to the metrics directly outside of the requests (e.g. jobs). """
+    collector = _collector.get()
+    if collector == None:
+        stage_duration.observe((name,), seconds)
+        return
+    with collector.lock:
+        collector.stages.append( (name, seconds) )
+
+def record_solver_status(status: str):
+    collector = _collector.get()
+    if collector == None:
+        solver_status_total.inc((status,))
+        return
+    with collector.lock:
+        collector.statuses[status] = collector.statuses.get(status, 0) + 1
+
+def merge(exported: Dict):
+    """ Add the values exported by Collector.export() (in a worker process) to the current request. """
+    for name, seconds in exported["stages"]:
+        record_stage(name, seconds)
+    for status, count in exported["statuses"].items():
+        for _ in range(count):
+            record_solver_status(status)
+
+@contextmanager
+def stage(name: str):
+    """ Measure the time of the block as the stage 'name'. """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start)
+
+def render_values(name: str, help: str, label_names: Tuple[str, ...], values: Dict[Tuple, float], type_name: str = "gauge"):
+    """ Format the values computed at the time of the scrape, such as the cache statistics. """
+    lines = ["# HELP {} {}".format(name, help), "# TYPE {} {}".format(name, type_name)]
+    for labels, value in sorted(values.items()):
+        lines.append("{}{} {}".format(name, _format_labels(label_names, labels), _format_value(value)))
+    return lines
+
+def render(*extra_lines) -> str:
+    """ Returns all the metrics in the Prometheus text format. """
+    lines = []
+    for metric in (request_duration, requests_total, requests_in_flight, stage_duration, solver_status_total):
+        lines += metric.render()
+    for extra in extra_lines:
+        lines += extra
+    return "\n".join(lines) + "\n"
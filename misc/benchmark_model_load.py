@@ -0,0 +1,34 @@
+""" Compare the cold-load time of the compiled model against cobra.io.read_sbml_model.
+
+Usage: python misc/benchmark_model_load.py ./models/iJO1366.xml [repeat]
+"""
+import os
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import cobra.io
+import compiled_model
+
+def measure(func, repeat: int):
+    elapsed = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed.append(time.perf_counter() - start)
+    return min(elapsed), sum(elapsed) / len(elapsed)
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    sbml_path = sys.argv[1]
+    repeat = int(sys.argv[2]) if 3 <= len(sys.argv) else 3
+
+    if compiled_model.load_compiled_model(sbml_path) == None:
+        compiled_model.compile_model(sbml_path)
+
+    sbml_min, sbml_mean = measure(lambda: cobra.io.read_sbml_model(sbml_path), repeat)
+    compiled_min, compiled_mean = measure(lambda: compiled_model.load_compiled_model(sbml_path), repeat)
+    print("read_sbml_model     : min {:.3f}s  mean {:.3f}s".format(sbml_min, sbml_mean))
+    print("load_compiled_model : min {:.3f}s  mean {:.3f}s".format(compiled_min, compiled_mean))
+    print("speedup             : x{:.1f}".format(sbml_mean / compiled_mean))
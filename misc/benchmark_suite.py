@@ -0,0 +1,287 @@
+""" Microbenchmarks of the hot paths of the server, without the HTTP layer.
+
+The benchmarks run offline. The sample1 model, its view and the annotation databases
+are generated into a temporary directory; iJO1366 is measured too if ./models/iJO1366.xml exists.
+
+Usage: python misc/benchmark_suite.py [-o result.json] [-b baseline.json] [-t 0.2] [-r 5] [-k filter] [--quick]
+
+  -o: write the results as JSON. The file can be used as the baseline of the later runs.
+  -b: compare the results against the baseline. The exit code is 1 if some of them are
+      slower than the baseline by more than the threshold (-t, ratio of the median).
+  -r: number of the repetitions of each benchmark (the median is compared).
+  -k: run only the benchmarks whose names contain the string.
+  --quick: skip the registry of 10,000 entries and iJO1366.
+
+Run it from the top directory of the repository.
+"""
+import os
+import io
+import sys
+import json
+import time
+import timeit
+import shutil
+import platform
+import argparse
+import tempfile
+import statistics
+from contextlib import redirect_stdout
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import yaml
+import cobra
+import cobra.io
+
+import information
+import obj_manager
+from id_mapping import IdMapper
+from model_cache import model_cache
+from model_handler import ModelHandler
+from solution_cache import solution_cache
+from view_cache import ViewTables
+
+IJO1366Path = "./models/iJO1366.xml"
+IJO1366ViewPath = "./models/iJO1366.cyjs"
+CommandCounts = (0, 10, 100)
+RegistrySizes = (10, 1000, 10000)
+# Number of the records of the generated annotation databases.
+DatabaseSize = 20000
+
+def build_sample1(path: str):
+    """ Same model as misc/build_model.py """
+    from cobra import Model, Reaction, Metabolite
+    model = Model('example_model')
+    A = Metabolite('A', compartment='c')
+    B = Metabolite('B', compartment='c')
+    C = Metabolite('C', compartment='c')
+    reactions = []
+    for name, stoichiometry in [('Atrans', {A: +1}), ('Btrans', {B: -1}), ('Ctrans', {C: -1}),
+            ('AtoB', {A: -1, B: +1}), ('AtoC', {A: -1, C: +1}), ('CtoB', {C: -1, B: +1})]:
+        reaction = Reaction(name)
+        reaction.add_metabolites(stoichiometry)
+        reactions.append(reaction)
+    model.add_reactions(reactions)
+    model.objective = 'Btrans'
+    cobra.io.write_sbml_model(model, path)
+
+def build_view(model_path: str, view_path: str):
+    """ Write a minimal view: an edge per reaction and a node per metabolite. """
+    model = cobra.io.read_sbml_model(model_path)
+    nodes = [{"data": {"id": str(i), "name": m.id, "node_type": "metabolite"}}
+            for i, m in enumerate(model.metabolites)]
+    offset = len(nodes)
+    edges = [{"data": {"id": str(offset + i), "name": r.id}} for i, r in enumerate(model.reactions)]
+    with open(view_path, "w") as f:
+        json.dump({"elements": {"nodes": nodes, "edges": edges}}, f)
+
+def build_databases(directory: str):
+    """ Write the BiGG, MetaNetX and id2id files of DatabaseSize records. Returns their paths. """
+    bigg_path = os.path.join(directory, "bigg_models_reactions.txt")
+    mtnx_path = os.path.join(directory, "reac_prop.tsv")
+    id2id_path = os.path.join(directory, "id2id.tsv")
+    with open(bigg_path, "w") as f:
+        f.write("bigg_id\tname\treaction_string\tmodel_list\tdatabase_links\told_bigg_ids\n")
+        for i in range(DatabaseSize):
+            f.write("R{0}\treaction {0}\tm{0}_c --> m{1}_c\tiJO1366\tEC: 1.1.1.{0}\tR{0}_old\n".format(i, i + 1))
+    with open(mtnx_path, "w") as f:
+        f.write("# generated by benchmark_suite.py\n")
+        for i in range(DatabaseSize):
+            f.write("MNXR{0}\t1 MNXM{0}@MNXD1 = 1 MNXM{1}@MNXD1\tbigg:R{0}\t1.1.1.{0}\tB\t\n".format(i, i + 1))
+    with open(id2id_path, "w") as f:
+        for i in range(DatabaseSize):
+            f.write("bigg.reaction\tR{0}\tmetanetx.reaction\tMNXR{0}\n".format(i))
+    return bigg_path, mtnx_path, id2id_path
+
+def build_registry(directory: str, size: int):
+    """ Write the registry files with 'size' user models. Returns the paths of the three lists. """
+    base_model_list = os.path.join(directory, "base_model_list.yaml")
+    view_list = os.path.join(directory, "view_list.yaml")
+    user_model_list = os.path.join(directory, "modifications_list.yaml")
+    with open(base_model_list, "w") as f:
+        yaml.dump({obj_manager.ModelRootKey: {"sample1": {"path": "sample1.xml"}}}, f)
+    with open(view_list, "w") as f:
+        yaml.dump({obj_manager.ViewRootKey: {"sample1": {"model": "sample1", "path": "sample1.cyjs"}}}, f)
+    user_models = {}
+    for i in range(size):
+        user_models["user{}".format(i)] = {"path": "user{}.yaml".format(i), "base_model": "sample1",
+                "parent_model": "sample1" if i == 0 else "user{}".format(i - 1), "date": "2024-01-01_00:00:00"}
+    with open(user_model_list, "w") as f:
+        yaml.dump({obj_manager.UserModelRootKey: user_models}, f, Dumper=getattr(yaml, "CSafeDumper", yaml.SafeDumper))
+    return base_model_list, view_list, user_model_list
+
+
+class Suite:
+    def __init__(self, repeat: int, name_filter: str = None):
+        self.repeat = repeat
+        self.name_filter = name_filter
+        self.results = {}
+
+    def measure(self, name: str, func):
+        """ Run func repeatedly and record the time of a call.
+        Fast functions are called in a loop of at least 0.2 seconds (same as timeit). """
+        if self.name_filter != None and not self.name_filter in name:
+            return
+        # The server prints a lot. It is not a part of the measurement.
+        with redirect_stdout(io.StringIO()):
+            func()
+            timer = timeit.Timer(func)
+            number, _ = timer.autorange()
+            times = [t / number for t in timer.repeat(repeat=self.repeat, number=number)]
+        self.results[name] = {
+            "min": min(times),
+            "median": statistics.median(times),
+            "mean": statistics.mean(times),
+            "stdev": statistics.stdev(times) if 1 < len(times) else 0.0,
+            "number": number,
+            "repeat": self.repeat,
+        }
+        print("{:<45} median {:>12} (min {})".format(name, format_time(self.results[name]["median"]),
+                format_time(self.results[name]["min"])))
+        sys.stdout.flush()
+
+
+def format_time(seconds: float) -> str:
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if scale <= seconds:
+            return "{:.3f} {}".format(seconds / scale, unit)
+    return "{:.1f} ns".format(seconds / 1e-9)
+
+def bench_model(suite: Suite, label: str, model_path: str, view_path: str):
+    suite.measure("read_sbml_model[{}]".format(label), lambda: cobra.io.read_sbml_model(model_path))
+
+    reactions = model_cache.get_entry(model_path).model.reactions
+    for count in CommandCounts:
+        # Set the original bounds, so that the model stays feasible with any number of the commands.
+        commands = [["bound", r.id, r.lower_bound, r.upper_bound]
+                for r in (reactions[i % len(reactions)] for i in range(count))]
+        def fba(commands=commands):
+            # Solve every time, not to measure the solution cache.
+            solution_cache.clear()
+            handler = ModelHandler(label, model_path)
+            for command in commands:
+                handler.add_modification_command(command)
+            return handler.do_FBA()
+        suite.measure("do_FBA[{}, commands={}]".format(label, count), fba)
+
+    def view_map():
+        with open(view_path) as f:
+            return ViewTables(json.load(f)).edge_to_reaction
+    suite.measure("view_id_map[{}]".format(label), view_map)
+
+def bench_information(suite: Suite, directory: str):
+    bigg_path, mtnx_path, id2id_path = build_databases(directory)
+    information.BiggReactionDB = bigg_path
+    information.MetaNetXReactionDB = mtnx_path
+    information.id_mapper = IdMapper(id2id_path)
+    ids = ["R{}".format(i) for i in range(0, DatabaseSize, DatabaseSize // 100)]
+
+    def build_bigg():
+        store = information.bigg_reaction_store()
+        store.close()
+        if os.path.isfile(store.index_path):
+            os.remove(store.index_path)
+        store.build()
+    suite.measure("bigg.build_index", build_bigg)
+    suite.measure("bigg.lookup", lambda: information.get_reaction_information_bigg("R123"))
+    suite.measure("bigg.lookup_many[100]", lambda: information.get_reaction_information_many(ids, "bigg"))
+    suite.measure("metanetx.lookup", lambda: information.get_reaction_information_mtnx("MNXR123"))
+    suite.measure("metanetx.lookup_many[100]",
+            lambda: information.get_reaction_information_many(["MNX" + i for i in ids], "metanetx"))
+
+    def load_id2id():
+        information.id_mapper.signature = None
+        information.id_mapper.load()
+    suite.measure("convert_name.load", load_id2id)
+    suite.measure("convert_name", lambda: information.convert_name("bigg.reaction", "R123", "metanetx.reaction"))
+
+def bench_registry(suite: Suite, directory: str, sizes):
+    saved = (obj_manager.BaseModelList, obj_manager.ViewList, obj_manager.UserModificationList)
+    try:
+        for size in sizes:
+            registry_dir = os.path.join(directory, "registry{}".format(size))
+            os.mkdir(registry_dir)
+            obj_manager.BaseModelList, obj_manager.ViewList, obj_manager.UserModificationList = \
+                    build_registry(registry_dir, size)
+            manager = obj_manager.ModelViewManager(refresh_interval=0)
+            counter = [0]
+            def register():
+                counter[0] += 1
+                name = "new{}".format(counter[0])
+                manager.register_model(name, name + ".yaml", "sample1", "user0")
+            suite.measure("register_model[registry={}]".format(size), register)
+    finally:
+        obj_manager.BaseModelList, obj_manager.ViewList, obj_manager.UserModificationList = saved
+
+def compare(results, baseline, threshold: float):
+    """ Print the ratio of the medians. Returns the names of the regressions. """
+    regressions = []
+    print()
+    print("{:<45} {:>12} {:>12} {:>8}".format("benchmark", "baseline", "current", "ratio"))
+    for name, result in results.items():
+        if not name in baseline:
+            continue
+        ratio = result["median"] / baseline[name]["median"]
+        mark = ""
+        if 1.0 + threshold < ratio:
+            mark = "  REGRESSION"
+            regressions.append(name)
+        print("{:<45} {:>12} {:>12} {:>7.2f}x{}".format(name, format_time(baseline[name]["median"]),
+                format_time(result["median"]), ratio, mark))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the hot paths of the server.")
+    parser.add_argument("-o", "--output")
+    parser.add_argument("-b", "--baseline")
+    parser.add_argument("-t", "--threshold", type=float, default=0.2)
+    parser.add_argument("-r", "--repeat", type=int, default=5)
+    parser.add_argument("-k", "--filter")
+    parser.add_argument("--quick", action="store_true")
+    args = parser.parse_args()
+
+    # Do not read or write the on-disk tier of the solution cache.
+    solution_cache.disk_dir = None
+    suite = Suite(args.repeat, args.filter)
+    directory = tempfile.mkdtemp(prefix="kosmogora-bench-")
+    try:
+        with redirect_stdout(io.StringIO()):
+            sample1_path = os.path.join(directory, "sample1.xml")
+            sample1_view_path = os.path.join(directory, "sample1.cyjs")
+            build_sample1(sample1_path)
+            build_view(sample1_path, sample1_view_path)
+        bench_model(suite, "sample1", sample1_path, sample1_view_path)
+        if not args.quick and os.path.isfile(IJO1366Path):
+            view_path = IJO1366ViewPath
+            if not os.path.isfile(view_path):
+                view_path = os.path.join(directory, "iJO1366.cyjs")
+                build_view(IJO1366Path, view_path)
+            bench_model(suite, "iJO1366", IJO1366Path, view_path)
+        bench_information(suite, directory)
+        sizes = RegistrySizes[:-1] if args.quick else RegistrySizes
+        bench_registry(suite, directory, sizes)
+    finally:
+        information.bigg_reaction_store().close()
+        information.mtnx_reaction_store().close()
+        shutil.rmtree(directory)
+
+    output = {
+        "meta": {
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "cobra": cobra.__version__,
+            "machine": platform.machine(),
+            "platform": platform.platform(),
+        },
+        "results": suite.results,
+    }
+    if args.output != None:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+    if args.baseline != None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        if 0 < len(compare(suite.results, baseline, args.threshold)):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
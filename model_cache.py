@@ -0,0 +1,113 @@
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Optional
+
+from compiled_model import load_model
+from metrics import stage
+
+# Memory budget for the parsed models kept in this process (bytes).
+# It can be overridden by the environment variable KOSMOGORA_MODEL_CACHE_BYTES.
+DefaultMemoryBudget = 2 * 1024 ** 3
+
+# A parsed cobra.Model is much larger than its SBML file.
+# The memory consumption of each entry is estimated by (file size) * ModelSizeFactor.
+ModelSizeFactor = 8
+
+
+class _CacheEntry:
+    def __init__(self, signature, model, size: int):
+        self.signature = signature
+        self.model = model
+        self.size = size
+        # cobra's context manager is not re-entrant among threads,
+        # so the requests which use the same model are serialized by this lock.
+        self.lock = threading.RLock()
+
+
+class ModelCache:
+    """ Process-wide LRU cache of the parsed cobra.Model objects.
+
+    The models are keyed by the absolute path of the SBML file and
+    invalidated when the modification time or the size of the file changes.
+    Modifications by each request must be done inside use_model(),
+    which reverts them through the cobra's context manager.
+    """
+    def __init__(self, memory_budget: Optional[int] = None):
+        if memory_budget == None:
+            memory_budget = int(os.environ.get("KOSMOGORA_MODEL_CACHE_BYTES", DefaultMemoryBudget))
+        self.memory_budget = memory_budget
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _signature(self, path: str):
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size)
+
+    def _load(self, path: str):
+        # Use the precompiled model if available. (see compiled_model.py)
+        return load_model(path)
+
+    def _evict(self):
+        # Evict the least recently used models, but keep at least the newest one.
+        total = sum(entry.size for entry in self.entries.values())
+        while total > self.memory_budget and len(self.entries) > 1:
+            _, entry = self.entries.popitem(last=False)
+            total -= entry.size
+            self.evictions += 1
+
+    def get_entry(self, model_path: str) -> _CacheEntry:
+        path = os.path.abspath(model_path)
+        signature = self._signature(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry != None and entry.signature == signature:
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        # Parse outside of the lock so that other models can be served meanwhile.
+        with stage("model_load"):
+            model = self._load(path)
+        entry = _CacheEntry(signature, model, signature[1] * ModelSizeFactor)
+        with self.lock:
+            self.entries[path] = entry
+            self.entries.move_to_end(path)
+            self._evict()
+        return entry
+
+    @contextmanager
+    def use_model(self, model_path: str):
+        """ Yields the cached model. All changes made in this block are reverted on exit. """
+        entry = self.get_entry(model_path)
+        with entry.lock:
+            with entry.model as model:
+                yield model
+
+    def invalidate(self, model_path: Optional[str] = None):
+        with self.lock:
+            if model_path == None:
+                self.entries.clear()
+            else:
+                self.entries.pop(os.path.abspath(model_path), None)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": (self.hits / total) if 0 < total else 0.0,
+                "entries": len(self.entries),
+                "estimated_bytes": sum(entry.size for entry in self.entries.values()),
+                "memory_budget": self.memory_budget,
+            }
+
+
+model_cache = ModelCache()
@@ -1,6 +1,10 @@
-import json
-import cobra.io
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Tuple
+from model_cache import model_cache
+from annotation_store import get_store
+from view_cache import view_cache
+from solution_cache import solution_cache
+from compiled_model import source_checksum
+from metrics import stage, record_solver_status
 
 class ModelHandler:
     def __init__(self, base_model_name : Optional[str] = None, base_model_path: Optional[str] = None):
@@ -16,6 +20,8 @@ class ModelHandler:
         self.id_type = None
 
         self.edgeID_to_rxnID_table = {}
+        # modification_list resolved to the final bounds. (see compile_modifications())
+        self.compiled = None
         pass
 
     def set_base_model(self, base_model_name : str, base_model_path : str):
@@ -48,16 +54,23 @@ class ModelHandler:
         print("id_type: {} registered.".format(id_type))
 
     def list_reaction_ids(self):
-        self.model = cobra.io.read_sbml_model(self.base_model_path)
-        return self.model.reactions.list_attr('id')
+        with model_cache.use_model(self.base_model_path) as model:
+            return model.reactions.list_attr('id')
 
-    def save_user_model(self, user_model_path : str):
+    def list_metabolite_ids(self):
+        with model_cache.use_model(self.base_model_path) as model:
+            return model.metabolites.list_attr('id')
+
+    def save_user_model(self, user_model_path : str, compiled: Optional[Dict] = None):
+        """ Save the user model. 'compiled' is the result of compile_modifications(), computed here if not given. """
         import yaml
         from datetime import datetime
         if self.author == None:
-            raise "Author is required. Please set the author by calling set_author()"
+            raise ValueError("Author is required. Please set the author by calling set_author()")
         if len(self.new_modifications) == 0:
-            raise "There are no new modification!"
+            raise ValueError("There are no new modification!")
+        if compiled == None:
+            compiled = self.compile_modifications()
         date_str = datetime.today().strftime("%Y-%m-%d_%H:%M:%S")
         temp_modification = {
             "author" : self.author,
@@ -70,7 +83,8 @@ class ModelHandler:
             "base_model_name" : self.base_model_name,
             "base_model_path" : self.base_model_path,
             "model_name" : self.model_name,
-            "modification_list" : self.modification_list
+            "modification_list" : self.modification_list,
+            "compiled" : compiled,
         }
         with open(user_model_path, "w") as file:
             yaml.dump(data, file)
@@ -89,10 +103,12 @@ class ModelHandler:
         self.base_model_path = user_defined_data["base_model_path"]
         self.modification_list = user_defined_data["modification_list"]
         self.model_name = user_defined_data["model_name"]
+        # The user models saved by the older version do not have it.
+        self.compiled = user_defined_data.get("compiled")
 
     def _apply_modification(self, modification_commands, id_table = None):
         if self.model == None:
-            raise 
+            raise RuntimeError("The model is not loaded.")
 
         for command in modification_commands:
             if command[0] == "knockout":
@@ -104,31 +120,105 @@ class ModelHandler:
                 if self.model.reactions.has_id(reaction_id):
                     self.model.reactions.get_by_id(reaction_id).knock_out()
                 else:
-                    raise "Reaction {} is not found!".format(reaction_id)
+                    raise KeyError("Reaction {} is not found!".format(reaction_id))
 
             elif command[0] == "bound":
                 reaction_id = command[1]
                 if id_table != None:
                     reaction_id = id_table[reaction_id]
-                    print("# {} -> {}".format(command[1]), reaction_id)
+                    print("# {} -> {}".format(command[1], reaction_id))
                 lower_bound = float(command[2])
                 upper_bound = float(command[3])
                 if self.model.reactions.has_id(reaction_id):
                     self.model.reactions.get_by_id(reaction_id).bounds = (lower_bound, upper_bound)
                     print("apply: bound: {} {} {}".format(reaction_id, lower_bound, upper_bound))
                 else:
-                    raise "Reaction {} is not found!".format(reaction_id)
+                    raise KeyError("Reaction {} is not found!".format(reaction_id))
             else:
-                raise "Unknown command"
-                pass
+                raise ValueError("Unknown command: {}".format(command[0]))
         
-    def do_FBA(self):
-        # First, load the original model
-        self.model = cobra.io.read_sbml_model(self.base_model_path)
+    def _resolve_commands(self, modification_commands, id_table = None):
+        """ Returns [(reaction_id, lower_bound, upper_bound), ...] of the commands. """
+        ret = []
+        for command in modification_commands:
+            reaction_id = command[1]
+            if id_table != None:
+                reaction_id = id_table[reaction_id]
+            if command[0] == "knockout":
+                ret.append( (reaction_id, 0.0, 0.0) )
+            elif command[0] == "bound":
+                ret.append( (reaction_id, float(command[2]), float(command[3])) )
+            else:
+                raise ValueError("Unknown command: {}".format(command[0]))
+        return ret
 
-        # second, apply the previously defined commands.
-        for modification in self.modification_list:
+    def effective_bounds(self, new_modifications: Optional[List] = None) -> Dict[str, Tuple[float, float]]:
+        """ Resolve all the modifications (previously defined and new ones) 
+        into the final bounds of each modified reaction.
+        If new_modifications is given, it is used instead of the commands added by add_modification_command().
+        """
+        if new_modifications == None:
+            new_modifications = self.new_modifications
+        bounds = {}
+        if self._compiled_is_valid():
+            for _, reaction_id, lb, ub in self.compiled["bounds"]:
+                bounds[reaction_id] = (lb, ub)
+        else:
+            for modification in self.modification_list:
+                id_table = None
+                if "id_type" in modification and modification["id_type"] != None:
+                    id_table = self.generate_edgeID_to_rxnID_map(modification["id_type"])
+                for reaction_id, lb, ub in self._resolve_commands(modification["commands"], id_table):
+                    bounds[reaction_id] = (lb, ub)
+
+        id_table = None
+        if self.id_type != None:
+            id_table = self.generate_edgeID_to_rxnID_map(self.id_type)
+        for reaction_id, lb, ub in self._resolve_commands(new_modifications, id_table):
+            bounds[reaction_id] = (lb, ub)
+        return bounds
 
+    def _compiled_is_valid(self) -> bool:
+        """ The compiled form can be used only if the base model has not been changed since it was compiled. """
+        if self.compiled == None:
+            return False
+        return self.compiled.get("base_model_checksum") == source_checksum(self.base_model_path)
+
+    def compile_modifications(self) -> Dict:
+        """ Resolve the modification_list and the new commands into the final bounds of each reaction,
+        with the index of the reaction in the base model.
+        Raises KeyError or ValueError if some of them can not be applied to the base model.
+        """
+        bounds = self.effective_bounds()
+        entries = []
+        with model_cache.use_model(self.base_model_path) as model:
+            for reaction_id, (lb, ub) in bounds.items():
+                if not model.reactions.has_id(reaction_id):
+                    raise KeyError("Reaction {} is not found!".format(reaction_id))
+                if ub < lb:
+                    raise ValueError("The lower bound {} of {} is greater than the upper bound {}.".format(lb, reaction_id, ub))
+                entries.append( [model.reactions.index(reaction_id), reaction_id, lb, ub] )
+        return {
+            "base_model_checksum": source_checksum(self.base_model_path),
+            "bounds": sorted(entries),
+        }
+
+    def _apply_compiled(self):
+        """ Set the final bounds of the modified reactions at once, instead of replaying the history. """
+        reactions = self.model.reactions
+        for index, reaction_id, lb, ub in self.compiled["bounds"]:
+            if index < len(reactions) and reactions[index].id == reaction_id:
+                reaction = reactions[index]
+            else:
+                reaction = reactions.get_by_id(reaction_id)
+            reaction.bounds = (lb, ub)
+
+    def _apply_modification_list(self):
+        """ Apply the previously defined commands. """
+        if self._compiled_is_valid():
+            self._apply_compiled()
+            return
+        for modification in self.modification_list:
             if "id_type" in modification and modification["id_type"] != None:
                 # If id_type is specified, convert the reaction ids to the bigg_id.
                 id_table = self.generate_edgeID_to_rxnID_map(modification["id_type"])
@@ -136,52 +226,169 @@ class ModelHandler:
             else:
                 self._apply_modification(modification["commands"])
 
-        
-        # Third, apply the current commands
-        if self.id_type != None:
-            id_table = self.generate_edgeID_to_rxnID_map(self.id_type)
-            self._apply_modification(self.new_modifications, id_table)
-        else:
-            self._apply_modification(self.new_modifications)
+    def do_FBA(self):
+        # The same scenario may have been solved already.
+        cache_key = solution_cache.make_key(self.base_model_path, self.effective_bounds())
+        data = solution_cache.get(cache_key)
+        if data != None:
+            return data
 
-        with self.model:
-            solution = self.model.optimize()
+        # First, get the original model from the cache.
+        # The modifications below are reverted when leaving the 'with' block.
+        with model_cache.use_model(self.base_model_path) as model:
+            self.model = model
+            try:
+                with stage("modify"):
+                    # second, apply the previously defined commands.
+                    self._apply_modification_list()
+
+                    # Third, apply the current commands
+                    if self.id_type != None:
+                        id_table = self.generate_edgeID_to_rxnID_map(self.id_type)
+                        self._apply_modification(self.new_modifications, id_table)
+                    else:
+                        self._apply_modification(self.new_modifications)
+
+                with stage("optimize"):
+                    solution = self.model.optimize()
+                record_solver_status(solution.status)
+            finally:
+                self.model = None
 
         data = {
             'fluxes': sorted(solution.fluxes.items(), key=lambda kv: kv[0]),
             'objective_value': solution.objective_value}
 
+        solution_cache.put(cache_key, data)
         return data
 
+    def do_FVA(self, reaction_ids: Optional[List[str]] = None, fraction_of_optimum: float = 1.0,
+            parts: int = 1):
+        """ Flux variability analysis. The reactions are split into 'parts' chunks, analyzed at once
+        in the worker pool (see worker_pool.py). Call it in the server process, not in a worker.
+
+        reaction_ids: reactions to be analyzed. All the reactions if None.
+        The IDs not in the model are returned in 'not_found'.
+        """
+        from worker_pool import worker_pool
+        found = None
+        not_found = []
+        if reaction_ids != None:
+            known = set(self.list_reaction_ids())
+            found = sorted(set(r for r in reaction_ids if r in known))
+            not_found = [r for r in reaction_ids if not r in known]
+        params = {"reactions": found, "fraction_of_optimum": fraction_of_optimum}
+        cache_key = solution_cache.make_key(self.base_model_path, self.effective_bounds(), "FVA", params)
+        data = solution_cache.get(cache_key)
+        if data == None:
+            reactions = found if found != None else sorted(self.list_reaction_ids())
+            if not worker_pool.enabled():
+                parts = 1
+            chunk_size = max(1, -(-len(reactions) // max(1, parts)))
+            chunks = [(reactions[i:i + chunk_size], fraction_of_optimum) for i in range(0, len(reactions), chunk_size)]
+            ranges = []
+            for chunk_ranges in worker_pool.run_all(self.fva_chunk, chunks):
+                ranges += chunk_ranges
+            data = {
+                'ranges': sorted(ranges),
+                'fraction_of_optimum': fraction_of_optimum}
+            solution_cache.put(cache_key, data)
+        return dict(data, not_found=not_found)
+
+    def fva_chunk(self, reactions: List[str], fraction_of_optimum: float):
+        """ FVA of the reactions. Returns [[reaction_id, minimum, maximum], ...].
+
+        In the server process, it runs on a copy of the modified model, so that the cached model
+        is locked only while it is copied. The worker process runs one task at a time and needs no copy.
+        """
+        from cobra.flux_analysis import flux_variability_analysis
+        from worker_pool import in_worker_process
+        with model_cache.use_model(self.base_model_path) as model:
+            self.model = model
+            try:
+                with stage("modify"):
+                    self._apply_modification_list()
+                    id_table = None
+                    if self.id_type != None:
+                        id_table = self.generate_edgeID_to_rxnID_map(self.id_type)
+                    self._apply_modification(self.new_modifications, id_table)
+                if in_worker_process():
+                    with stage("fva"):
+                        result = flux_variability_analysis(model, reaction_list=reactions,
+                                fraction_of_optimum=fraction_of_optimum, processes=1)
+                else:
+                    with stage("copy"):
+                        model = model.copy()
+            finally:
+                self.model = None
+        if not in_worker_process():
+            with stage("fva"):
+                result = flux_variability_analysis(model, reaction_list=reactions,
+                        fraction_of_optimum=fraction_of_optimum, processes=1)
+        return [[rxn_id, float(row["minimum"]), float(row["maximum"])] for rxn_id, row in result.iterrows()]
+
+    def solve_scenarios(self, scenarios: List[List[List[str]]], objective_only: bool = False):
+        """ Solve the scenarios in turn, reusing one loaded model and its solver problem.
+
+        Each scenario is a list of commands, applied on top of the modification_list of this model
+        and reverted after solving. The results are returned in the input order.
+        If a scenario can not be applied (unknown reaction etc.), its result is {"error": message}.
+        """
+        results = [None] * len(scenarios)
+        pending = []
+        for i, commands in enumerate(scenarios):
+            try:
+                cache_key = solution_cache.make_key(self.base_model_path, self.effective_bounds(commands))
+            except (KeyError, ValueError, IndexError) as e:
+                results[i] = {"error": "{}: {}".format(type(e).__name__, e)}
+                continue
+            data = solution_cache.get(cache_key)
+            if data != None:
+                results[i] = data
+            else:
+                pending.append( (i, commands, cache_key) )
+
+        if 0 < len(pending):
+            id_table = None
+            if self.id_type != None:
+                id_table = self.generate_edgeID_to_rxnID_map(self.id_type)
+            with model_cache.use_model(self.base_model_path) as model:
+                self.model = model
+                try:
+                    with stage("modify"):
+                        self._apply_modification_list()
+                    for i, commands, cache_key in pending:
+                        try:
+                            with model:
+                                with stage("modify"):
+                                    self._apply_modification(commands, id_table)
+                                with stage("optimize"):
+                                    solution = model.optimize()
+                                record_solver_status(solution.status)
+                        except (KeyError, ValueError, IndexError) as e:
+                            results[i] = {"error": "{}: {}".format(type(e).__name__, e)}
+                            continue
+                        data = {
+                            'fluxes': sorted(solution.fluxes.items(), key=lambda kv: kv[0]),
+                            'objective_value': solution.objective_value}
+                        solution_cache.put(cache_key, data)
+                        results[i] = data
+                finally:
+                    self.model = None
+
+        if objective_only:
+            results = [r if "error" in r else {"objective_value": r["objective_value"]} for r in results]
+        return results
+
     def generate_edgeID_to_rxnID_map(self, view_path: str):
         """ convert reactions specified the edgeID to its original name """
-        import json
-        edgeID_to_rxnID ={}
-        with open(view_path, 'r') as f:
-            view = json.load(f)
-            for edge in view["elements"]["edges"]:
-                edge_id = edge["data"]["id"]
-                rxn_id = edge["data"]["name"]
-                edgeID_to_rxnID[edge_id] = rxn_id
-        return edgeID_to_rxnID
+        # The table is shared among the requests. Do not modify it.
+        return view_cache.get(view_path).edge_to_reaction
 
     def generate_nodeID_to_metaboliteID_map(self, view_path: str):
-        import json
-        nodeID_to_mtbID = {}
-        with open(view_path, 'r') as f:
-            view = json.load(f)
-            for node in view["elements"]["nodes"]:
-                if node["data"]["node_type"] == "metabolite":
-                    node_id = node["data"]["id"]
-                    mtb_id = node["data"]["name"]
-                    nodeID_to_mtbID[node_id] = mtb_id
-        return nodeID_to_mtbID
+        return view_cache.get(view_path).node_to_metabolite
 
     def get_reaction_information(self, reaction_db_file: str, reaction_id: str, view_path: str = None):
-        print(reaction_db_file)
-        column_names = []
-        data = None
-
         if self.id_type != None:
             id_table = self.generate_edgeID_to_rxnID_map(self.id_type)
             if reaction_id in id_table:
@@ -189,20 +396,7 @@ class ModelHandler:
             else:
                 return {}
 
-        #find_flag = False
-        with open(reaction_db_file) as f:
-            for line_num, line in enumerate(f):
-                record = line.lstrip().rstrip().split('\t')
-                if line_num == 0:
-                    column_names = record
-                else:
-                    if record[0] == reaction_id:
-                        data = record
-        ret = {}
-        if data != None:
-            for (k,v) in zip(column_names, data):
-                ret[k] = v
-        return ret
+        return get_store(reaction_db_file).get_record(reaction_id)
 
     def get_reaction_name(self, reaction_id: str):
         if self.id_type != None:
@@ -214,9 +408,6 @@ class ModelHandler:
         return reaction_id
 
     def get_metabolite_information(self, metabolite_db_file: str, metabolite_id: str, view_path: str = None):
-        data = None
-        column_names = []
-
         if self.id_type != None:
             id_table = self.generate_nodeID_to_metaboliteID_map(self.id_type)
             if metabolite_id in id_table:
@@ -224,20 +415,28 @@ class ModelHandler:
             else:
                 return {}
 
-        with open(metabolite_db_file) as f:
-            for line_num, line in enumerate(f):
-                record = line.lstrip().rstrip().split('\t')
-                if line_num == 0:
-                    print(record)
-                    column_names = record
-                else:
-                    if record[0] == metabolite_id:
-                        data = record
-                        print(record)
+        return get_store(metabolite_db_file).get_record(metabolite_id)
+
+    def get_reaction_names(self, reaction_ids: List[str]) -> Dict[str, str]:
+        """ Same as get_reaction_name(), but the view is parsed only once. IDs not in the view are omitted. """
+        if self.id_type == None:
+            return {reaction_id: reaction_id for reaction_id in reaction_ids}
+        id_table = self.generate_edgeID_to_rxnID_map(self.id_type)
+        return {reaction_id: id_table[reaction_id] for reaction_id in reaction_ids if reaction_id in id_table}
+
+    def get_metabolite_information_many(self, metabolite_db_file: str, metabolite_ids: List[str]) -> Dict[str, Dict]:
+        """ Returns {metabolite_id: information} of the found metabolites in a single lookup. """
+        if self.id_type != None:
+            id_table = self.generate_nodeID_to_metaboliteID_map(self.id_type)
+            names = {mid: id_table[mid] for mid in metabolite_ids if mid in id_table}
+        else:
+            names = {mid: mid for mid in metabolite_ids}
+        store = get_store(metabolite_db_file)
+        records = store.get_many(names.values())
         ret = {}
-        if data != None:
-            for (k,v) in zip(column_names, data):
-                ret[k] = v
+        for metabolite_id, name in names.items():
+            if name in records:
+                ret[metabolite_id] = dict(zip(store.columns, records[name]))
         return ret
 
 if __name__ == '__main__':
@@ -1,7 +1,12 @@
 from typing import Optional
 from datetime import datetime
+from types import MappingProxyType
+from collections import ChainMap
+import threading
+import time
 import yaml
 import os
+from registry import UserModelRegistry
 
 DataDir = "./data2/"
 MetaInfoDir = "./manager2/"
@@ -14,71 +19,223 @@ BaseModelList = os.path.join(MetaInfoDir, "base_model_list.yaml")
 ViewList = os.path.join(MetaInfoDir, "view_list.yaml")
 UserModificationList = os.path.join(MetaInfoDir, "modifications_list.yaml")
 
+# Seconds between the checks of the registry files changed by the other processes.
+DefaultRefreshInterval = 0.5
+
 ModelRootKey = "models"
 ViewRootKey = "views"
 UserModelRootKey = "user_models"
 
+def _build_index(items):
+    """ Returns {key: (name, ...)} of the [(key, name), ...]. The tuples are made once at the end. """
+    index = {}
+    for key, name in items:
+        names = index.get(key)
+        if names == None:
+            index[key] = [name]
+        else:
+            names.append(name)
+    return {key: tuple(names) for key, names in index.items()}
+
+class _Layers:
+    """ Immutable dict made of a base dict and the changes layered on it.
+
+    An update copies only the changes, not the base. The changes are merged into a new base
+    when they grow to the square root of the base, so an update costs O(sqrt(n)) amortized.
+    """
+    __slots__ = ("base", "changes", "mapping")
+
+    def __init__(self, base: dict, changes: Optional[dict] = None):
+        self.base = base
+        self.changes = changes or {}
+        self.mapping = MappingProxyType(ChainMap(self.changes, base) if 0 < len(self.changes) else base)
+
+    def updated(self, changes: dict, removed=()):
+        if 0 < len(removed):
+            merged = {**self.base, **self.changes, **changes}
+            for key in removed:
+                merged.pop(key, None)
+            return _Layers(merged)
+        changes = {**self.changes, **changes}
+        if len(self.base) < len(changes) ** 2:
+            return _Layers({**self.base, **changes})
+        return _Layers(self.base, changes)
+
+def _update_index(layers: _Layers, updates):
+    """ Apply [(key, name to remove or None, name to add or None), ...] to the index. Only the affected entries are copied. """
+    changes = {}
+    for key, removed_name, added_name in updates:
+        names = changes.get(key, layers.mapping.get(key, ()))
+        if removed_name != None:
+            names = tuple(n for n in names if n != removed_name)
+        if added_name != None:
+            names = names + (added_name,)
+        changes[key] = names
+    removed = [key for key, names in changes.items() if len(names) == 0]
+    for key in removed:
+        del changes[key]
+    return layers.updated(changes, removed)
+
+class RegistrySnapshot:
+    """ Immutable state of the registry with the secondary indexes.
+
+    Readers get the current snapshot and never see a half-updated registry.
+    Writers build a new snapshot and swap it, so that the reads need no lock.
+    """
+    def __init__(self, base_model_set, view_set, user_model_layers: _Layers,
+            views_by_model, user_models_by_base_layers: _Layers, children_by_parent_layers: _Layers):
+        self.user_model_layers = user_model_layers
+        self.user_models_by_base_layers = user_models_by_base_layers
+        self.children_by_parent_layers = children_by_parent_layers
+        self.base_model_set = MappingProxyType(base_model_set)
+        self.view_set = MappingProxyType(view_set)
+        self.user_model_set = user_model_layers.mapping
+        # {model name: (view name, ...)}
+        self.views_by_model = MappingProxyType(views_by_model)
+        # {base model name: (user model name, ...)}
+        self.user_models_by_base = user_models_by_base_layers.mapping
+        # {parent model name: (user model name, ...)}
+        self.children_by_parent = children_by_parent_layers.mapping
+
+    @classmethod
+    def build(cls, base_model_set, view_set, user_model_set):
+        views_by_model = _build_index((property["model"], name) for name, property in view_set.items())
+        user_models_by_base = _build_index((property["base_model"], name) for name, property in user_model_set.items())
+        children_by_parent = _build_index((property["parent_model"], name) for name, property in user_model_set.items())
+        return cls(base_model_set, view_set, _Layers(user_model_set),
+                views_by_model, _Layers(user_models_by_base), _Layers(children_by_parent))
+
+    def with_user_models(self, entries):
+        """ Returns a new snapshot with the user models [(name, property), ...] added. 
+        Only the affected index entries are updated. """
+        user_models = {}
+        by_base = []
+        by_parent = []
+        for name, property in entries:
+            old_property = user_models.get(name, self.user_model_set.get(name))
+            if old_property != None:
+                by_base.append( (old_property["base_model"], name, None) )
+                by_parent.append( (old_property["parent_model"], name, None) )
+            user_models[name] = property
+            by_base.append( (property["base_model"], None, name) )
+            by_parent.append( (property["parent_model"], None, name) )
+        return RegistrySnapshot(self.base_model_set, self.view_set, self.user_model_layers.updated(user_models),
+                self.views_by_model, _update_index(self.user_models_by_base_layers, by_base),
+                _update_index(self.children_by_parent_layers, by_parent))
+
+
+def _file_signature(filename: str):
+    st = os.stat(filename)
+    return (st.st_mtime_ns, st.st_size)
+
 class ModelViewManager:
-    def __init__(self):
-        self.base_model_set = self.load_yaml(BaseModelList)[ModelRootKey]
-        self.view_set = self.load_yaml(ViewList)[ViewRootKey]
-        self.user_model_set = self.load_yaml(UserModificationList)[UserModelRootKey]
+    def __init__(self, refresh_interval: Optional[float] = None):
+        if refresh_interval == None:
+            refresh_interval = float(os.environ.get("KOSMOGORA_REGISTRY_REFRESH_INTERVAL", DefaultRefreshInterval))
+        self.refresh_interval = refresh_interval
+        self.last_refresh = time.monotonic()
+        self.user_model_registry = UserModelRegistry(UserModificationList, UserModelRootKey)
+        self.write_lock = threading.Lock()
+        self.base_model_signature = _file_signature(BaseModelList)
+        self.view_signature = _file_signature(ViewList)
+        self.user_model_signature = self.user_model_registry.signature()
+        user_model_set, self.journal_offset = self.user_model_registry.load_with_offset()
+        self.snapshot = RegistrySnapshot.build(
+                self.load_yaml(BaseModelList)[ModelRootKey],
+                self.load_yaml(ViewList)[ViewRootKey],
+                user_model_set)
         pass
 
+    def refresh_due(self) -> bool:
+        return self.refresh_interval <= time.monotonic() - self.last_refresh
+
+    def refresh(self, force: bool = False):
+        """ Reflect the changes made by the other processes (e.g. the other uvicorn workers).
+
+        The files are checked by stat() at most once in refresh_interval seconds.
+        The user models appended to the journal are read incrementally;
+        the whole YAML file is read only when it is rewritten.
+        It blocks on the file I/O, so run it in the I/O pool (see file_io.run_io).
+        """
+        if not force and not self.refresh_due():
+            return
+        # A registration holds the lock across the fsync (and may compact the registry).
+        # Do not wait for it; the next request refreshes.
+        if not self.write_lock.acquire(blocking=False):
+            return
+        try:
+            self.last_refresh = time.monotonic()
+            snapshot = self.snapshot
+            base_model_signature = _file_signature(BaseModelList)
+            view_signature = _file_signature(ViewList)
+            if base_model_signature != self.base_model_signature or view_signature != self.view_signature:
+                print("reload {} and {}".format(BaseModelList, ViewList))
+                snapshot = RegistrySnapshot.build(
+                        self.load_yaml(BaseModelList)[ModelRootKey],
+                        self.load_yaml(ViewList)[ViewRootKey],
+                        dict(snapshot.user_model_set))
+                self.base_model_signature = base_model_signature
+                self.view_signature = view_signature
+
+            yaml_signature, journal_size = self.user_model_registry.signature()
+            if yaml_signature != self.user_model_signature[0] or journal_size < self.journal_offset:
+                # Compacted or imported
+                print("reload {}".format(UserModificationList))
+                user_model_set, self.journal_offset = self.user_model_registry.load_with_offset()
+                snapshot = RegistrySnapshot.build(dict(snapshot.base_model_set), dict(snapshot.view_set), user_model_set)
+            elif self.journal_offset < journal_size:
+                entries, self.journal_offset = self.user_model_registry.read_journal(self.journal_offset)
+                snapshot = snapshot.with_user_models(entries)
+            self.user_model_signature = (yaml_signature, journal_size)
+            self.snapshot = snapshot
+        finally:
+            self.write_lock.release()
+
     def load_yaml(self, filename: str):
         with open(filename) as file:
             ret = yaml.safe_load(file)
         return ret
+
+    @property
+    def base_model_set(self):
+        return self.snapshot.base_model_set
+
+    @property
+    def view_set(self):
+        return self.snapshot.view_set
+
+    @property
+    def user_model_set(self):
+        return self.snapshot.user_model_set
     
     def list_models(self):
-        return list(self.base_model_set.keys() )
+        return list(self.snapshot.base_model_set.keys() )
 
     def get_user_model_tree(self):
-        tree = {}
-        for model_name, model_property in self.user_model_set.items():
-            parent_model = model_property["parent_model"]
-            if not parent_model in tree:
-                tree[parent_model] = set()
-            tree[parent_model].add(model_name)
-        return tree
+        return {parent: list(children) for parent, children in self.snapshot.children_by_parent.items()}
 
     def model_property(self, model_name : str):
-        if model_name in self.base_model_set:
-            return self.base_model_set[model_name]
-        else:
-            return None
+        return self.snapshot.base_model_set.get(model_name)
 
     def list_views(self, model_name : Optional[str] = None):
+        snapshot = self.snapshot
         if model_name != None:
-            ret = []
-            for name, property in self.view_set.items():
-                if property["model"] == model_name:
-                    ret.append(name)
-            return ret
+            return list(snapshot.views_by_model.get(model_name, ()))
         else:
-            return list(self.view_set.keys() )
+            return list(snapshot.view_set.keys() )
 
     def view_property(self, view_name: str):
-        if view_name in self.view_set:
-            return self.view_set[view_name]
-        else:
-            return None
+        return self.snapshot.view_set.get(view_name)
 
     def list_user_models(self, base_model_name : Optional[str] = None): 
+        snapshot = self.snapshot
         if base_model_name != None:
-            ret = []
-            for name, property in self.user_model_set.items():
-                if property["base_model"] == base_model_name:
-                    ret.append(name)
-            return ret
+            return list(snapshot.user_models_by_base.get(base_model_name, ()))
         else:
-            return ( list(self.user_model_set.keys()) )
+            return ( list(snapshot.user_model_set.keys()) )
 
     def user_model_property(self, user_model_name : str):
-        if user_model_name in self.user_model_set:
-            return self.user_model_set[user_model_name]
-        else:
-            return None
+        return self.snapshot.user_model_set.get(user_model_name)
 
 
     def check_model_type(self, model_name : str):
@@ -87,9 +244,10 @@ class ModelViewManager:
         return value:
             "base_model", "user_model", None (not exist)
         '''
-        if model_name in self.base_model_set:
+        snapshot = self.snapshot
+        if model_name in snapshot.base_model_set:
             return "base_model"
-        elif model_name in self.user_model_set:
+        elif model_name in snapshot.user_model_set:
             return "user_model"
         else:
             return None
@@ -103,10 +261,11 @@ class ModelViewManager:
             "parent_model" : parent_model,
             "date" : date_str
         }
-        self.user_model_set[user_model_name] = meta_data
+        with self.write_lock:
+            # Append to the journal instead of rewriting the whole list. (see registry.py)
+            self.user_model_registry.append(user_model_name, meta_data)
+            self.snapshot = self.snapshot.with_user_models([(user_model_name, meta_data)])
         print("ok save")
-        with open(UserModificationList, "w") as file:
-            yaml.dump( {UserModelRootKey: self.user_model_set}, file )
 
 def initialize():
     if not os.path.exists(MetaInfoDir):
@@ -136,6 +295,39 @@ def initialize():
     else:
         pass
 
+    compile_base_models()
+    compress_static_files()
+
+def compile_base_models():
+    """ Compile the registered SBML models into the fast-loading form. (see compiled_model.py) """
+    import compiled_model
+    with open(BaseModelList) as file:
+        base_model_set = yaml.safe_load(file)[ModelRootKey]
+    for model_name, model_property in base_model_set.items():
+        model_path = model_property["path"]
+        if not os.path.isfile(model_path):
+            print("{} is not found. Skip compiling {}.".format(model_path, model_name))
+            continue
+        if compiled_model.load_compiled_model(model_path) == None:
+            print("compile {}".format(model_path))
+            compiled_model.compile_model(model_path)
+
+def compress_static_files():
+    """ Write the compressed variants of the registered SBML and view files, served by Accept-Encoding. (see http_cache.py) """
+    import http_cache
+    paths = []
+    for list_path, root_key in ((BaseModelList, ModelRootKey), (ViewList, ViewRootKey)):
+        with open(list_path) as file:
+            entries = yaml.safe_load(file)[root_key]
+        paths += [property["path"] for property in entries.values()]
+    for path in paths:
+        if not os.path.isfile(path):
+            continue
+        try:
+            http_cache.prepare_variants(path)
+        except OSError as e:
+            print("failed to compress {}: {}".format(path, e))
+
 def _cleanup():
     import shutil
     if os.path.exists(MetaInfoDir):
@@ -151,6 +343,15 @@ if __name__ == '__main__':
             print("clean up {} and {}".format(DataDir, MetaInfoDir))
             _cleanup()
             initialize()
+        elif sys.argv[1] == '-m':
+            compile_base_models()
+            compress_static_files()
+        elif sys.argv[1] == '-e' and 3 <= len(sys.argv):
+            UserModelRegistry(UserModificationList, UserModelRootKey).export_yaml(sys.argv[2])
+        elif sys.argv[1] == '-i' and 3 <= len(sys.argv):
+            UserModelRegistry(UserModificationList, UserModelRootKey).import_yaml(sys.argv[2])
     else:
         print("If you specify the option '-c', it will clean all the user_defined models and reset. ")
+        print("If you specify the option '-m', it will compile and compress the registered models and views. ")
+        print("If you specify the option '-e file.yaml' or '-i file.yaml', it will export or import the user models. ")
 
@@ -0,0 +1,100 @@
+import os
+import re
+import uuid
+import random
+import cProfile
+import functools
+import contextvars
+from typing import Optional
+
+# The profiling can be configured by the following environment variables.
+#   KOSMOGORA_PROFILE_ENABLED:     set 1 to allow the profiling (default: 0). The requests are never profiled otherwise.
+#   KOSMOGORA_PROFILE_DIR:         directory of the profiles (default: ./profiles/).
+#   KOSMOGORA_PROFILE_SAMPLE_RATE: ratio of the /solve and /save requests profiled automatically (default: 0).
+#   KOSMOGORA_PROFILE_TOKEN:       if set, the profile header (or query parameter) must be this value.
+DefaultProfileDir = "./profiles/"
+ProfileHeader = "X-Kosmogora-Profile"
+ProfileQuery = "profile"
+ProfilePathHeader = "X-Kosmogora-Profile-Path"
+RequestIdHeader = "X-Request-ID"
+# The requests sampled by KOSMOGORA_PROFILE_SAMPLE_RATE.
+SampledPathPrefixes = ("/solve/", "/save/")
+
+_request_id_pattern = re.compile(r"^[A-Za-z0-9_.-]{1,64}$")
+
+class ProfiledRequest:
+    def __init__(self, request_id: str):
+        self.request_id = request_id
+        # Set when the profile is written.
+        self.path = None
+
+
+class RequestProfiler:
+    """ Runs the selected requests under cProfile, and writes the profile as <request ID>.pstats.
+
+    A request is profiled if the profiling is enabled, and it has the header (or the query parameter 'profile'),
+    or it is sampled. Only the endpoint function decorated by profiled() is profiled, in its own thread,
+    and the worker pool runs the tasks of the profiled request inline, so that the profile covers them.
+    The profile can be read by 'python -m pstats <file>' or snakeviz.
+    """
+    def __init__(self, enabled: Optional[bool] = None, directory: Optional[str] = None,
+            sample_rate: Optional[float] = None, token: Optional[str] = None):
+        if enabled == None:
+            enabled = os.environ.get("KOSMOGORA_PROFILE_ENABLED", "0") == "1"
+        if directory == None:
+            directory = os.environ.get("KOSMOGORA_PROFILE_DIR", DefaultProfileDir)
+        if sample_rate == None:
+            sample_rate = float(os.environ.get("KOSMOGORA_PROFILE_SAMPLE_RATE", 0))
+        if token == None:
+            token = os.environ.get("KOSMOGORA_PROFILE_TOKEN")
+        self.enabled = enabled
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.token = token
+        self.current = contextvars.ContextVar("kosmogora_profiled_request", default=None)
+
+    def is_requested(self, path: str, flag: Optional[str]) -> bool:
+        if not self.enabled:
+            return False
+        if flag != None:
+            if self.token != None:
+                return flag == self.token
+            return flag.lower() in ("1", "true", "yes")
+        return path.startswith(SampledPathPrefixes) and random.random() < self.sample_rate
+
+    def start(self, request_id: Optional[str] = None):
+        """ Mark the current request as profiled. Returns the ProfiledRequest and the token for stop(). """
+        if request_id == None or not _request_id_pattern.match(request_id):
+            request_id = uuid.uuid4().hex
+        request = ProfiledRequest(request_id)
+        return request, self.current.set(request)
+
+    def stop(self, token: contextvars.Token):
+        self.current.reset(token)
+
+    def active(self) -> bool:
+        return self.current.get() != None
+
+    def run(self, fn, *args, **kwargs):
+        request = self.current.get()
+        if request == None:
+            return fn(*args, **kwargs)
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(fn, *args, **kwargs)
+        finally:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, "{}.pstats".format(request.request_id))
+            profile.dump_stats(path)
+            request.path = path
+            print("profile: {}".format(path))
+
+
+request_profiler = RequestProfiler()
+
+def profiled(fn):
+    """ Decorator of the (synchronous) endpoints, to profile them when the request is profiled. """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        return request_profiler.run(fn, *args, **kwargs)
+    return wrapper
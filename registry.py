@@ -0,0 +1,177 @@
+import os
+import json
+import threading
+import yaml
+from contextlib import contextmanager
+from typing import Dict
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: only the threads in this process are serialized.
+    fcntl = None
+
+# The journal is merged into the YAML file when it has this number of entries.
+DefaultCompactThreshold = 1000
+
+class UserModelRegistry:
+    """ Append-only registry of the user models.
+
+    The registry consists of the YAML snapshot (modifications_list.yaml) and the journal next to it.
+    Each registration appends one JSON line to the journal, so a save costs O(1)
+    instead of rewriting the whole YAML file. The journal is merged into the snapshot
+    (compaction) when it grows, by writing a temporary file and renaming it atomically.
+    The writes are serialized among the processes by a lock file.
+    """
+    def __init__(self, yaml_path: str, root_key: str, compact_threshold: int = DefaultCompactThreshold):
+        self.yaml_path = yaml_path
+        self.root_key = root_key
+        self.journal_path = yaml_path + ".journal"
+        self.lock_path = yaml_path + ".lock"
+        self.compact_threshold = compact_threshold
+        self.thread_lock = threading.Lock()
+        # (snapshot signature, journal offset, number of entries before the offset) counted by append().
+        # The count is valid while the snapshot is not rewritten (i.e. the journal is not truncated).
+        self._journal_count = (None, 0, 0)
+
+    @contextmanager
+    def _locked(self):
+        with self.thread_lock:
+            if fcntl == None:
+                yield
+                return
+            with open(self.lock_path, "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load_snapshot(self) -> Dict:
+        with open(self.yaml_path) as file:
+            data = yaml.safe_load(file)
+        return data[self.root_key] or {}
+
+    def _read_journal(self, offset: int = 0):
+        """ Returns ([(name, property), ...], the offset of the end of the last complete line). """
+        entries = []
+        if not os.path.isfile(self.journal_path):
+            return entries, 0
+        with open(self.journal_path, "rb") as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # The line being written (or torn by a crash).
+                    break
+                offset += len(line)
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                entries.append( (record["name"], record["property"]) )
+        return entries, offset
+
+    def load(self) -> Dict:
+        """ Returns {user_model_name: property} of the snapshot and the journal. """
+        entries, _ = self.load_with_offset()
+        return entries
+
+    def load_with_offset(self):
+        """ Same as load(), but also returns the offset of the journal to be passed to read_journal(). """
+        entries = self._load_snapshot()
+        journal, offset = self._read_journal()
+        for name, property in journal:
+            entries[name] = property
+        return entries, offset
+
+    def read_journal(self, offset: int):
+        """ Returns the entries appended after the offset, and the new offset. """
+        return self._read_journal(offset)
+
+    def signature(self):
+        """ Changes when the snapshot is rewritten (compaction or import), or the journal is truncated. """
+        st = os.stat(self.yaml_path)
+        journal_size = os.path.getsize(self.journal_path) if os.path.isfile(self.journal_path) else 0
+        return (st.st_mtime_ns, st.st_size), journal_size
+
+    def _cut_partial_line(self, f):
+        """ Truncate the journal to the end of the last complete line.
+
+        A crash while appending leaves a partial line. Without this, the next record would be
+        written after it, and both would be skipped as one broken line.
+        """
+        end = f.seek(0, os.SEEK_END)
+        if end == 0:
+            return
+        f.seek(end - 1)
+        if f.read(1) == b"\n":
+            return
+        size = end
+        while 0 < end:
+            start = max(0, end - 4096)
+            f.seek(start)
+            position = f.read(end - start).rfind(b"\n")
+            if 0 <= position:
+                end = start + position + 1
+                break
+            end = start
+        print("cut the partial line at the end of {} ({} bytes)".format(self.journal_path, size - end))
+        f.truncate(end)
+
+    def _count_journal(self) -> int:
+        """ Number of the entries in the journal. Only the lines appended since the last call are read. """
+        snapshot_signature, _ = self.signature()
+        signature, offset, count = self._journal_count
+        if signature != snapshot_signature:
+            offset, count = 0, 0
+        entries, offset = self._read_journal(offset)
+        count += len(entries)
+        self._journal_count = (snapshot_signature, offset, count)
+        return count
+
+    def append(self, name: str, property: Dict):
+        line = json.dumps({"name": name, "property": property}) + "\n"
+        with self._locked():
+            with open(self.journal_path, "a+b") as f:
+                self._cut_partial_line(f)
+                f.write(line.encode())
+                f.flush()
+                os.fsync(f.fileno())
+            if self.compact_threshold <= self._count_journal():
+                self._compact()
+
+    def _write_snapshot(self, entries: Dict):
+        tmp_path = "{}.{}.tmp".format(self.yaml_path, os.getpid())
+        with open(tmp_path, "w") as file:
+            yaml.dump({self.root_key: entries}, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.yaml_path)
+
+    def _compact(self):
+        # If it crashes after the rename, the journal is replayed again on the new snapshot.
+        # It is harmless since the replay is idempotent.
+        self._write_snapshot(self.load())
+        with open(self.journal_path, "wb") as f:
+            os.fsync(f.fileno())
+
+    def compact(self):
+        with self._locked():
+            self._compact()
+
+    def export_yaml(self, path: str):
+        """ Write all the entries in the same format as modifications_list.yaml. """
+        entries = self.load()
+        with open(path, "w") as file:
+            yaml.dump({self.root_key: entries}, file)
+
+    def import_yaml(self, path: str):
+        """ Merge the entries of the YAML file (same format as modifications_list.yaml). """
+        with open(path) as file:
+            entries = yaml.safe_load(file)[self.root_key] or {}
+        with self._locked():
+            merged = self.load()
+            merged.update(entries)
+            self._write_snapshot(merged)
+            with open(self.journal_path, "wb") as f:
+                os.fsync(f.fileno())
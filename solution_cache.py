@@ -0,0 +1,176 @@
+import os
+import json
+import time
+import pickle
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional, Dict, Tuple
+
+from compiled_model import source_checksum
+
+# The cache can be configured by the following environment variables.
+#   KOSMOGORA_SOLUTION_CACHE_BYTES: memory budget (bytes)
+#   KOSMOGORA_SOLUTION_CACHE_TTL:   lifetime of each entry (seconds)
+#   KOSMOGORA_SOLUTION_CACHE_DIR:   directory of the on-disk tier (disabled if not set)
+DefaultMemoryBudget = 256 * 1024 ** 2
+DefaultTTL = 24 * 3600
+
+
+def _freeze(value):
+    """ Convert the lists to tuples, so that the callers sharing the cached value can not modify it. """
+    if isinstance(value, dict):
+        return {k: _freeze(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+def _copy(value):
+    # The sequences are frozen. A copy of the dict is enough to protect the cached value.
+    if isinstance(value, dict):
+        return dict(value)
+    return value
+
+class _CacheEntry:
+    def __init__(self, value, size: int, expires_at: float):
+        self.value = value
+        self.size = size
+        self.expires_at = expires_at
+
+
+class SolutionCache:
+    """ Cache of the analysis results (such as FBA solutions).
+
+    The key consists of the identity of the base model (path and checksum of the SBML file),
+    the kind of the analysis and the effective modifications resolved to reaction IDs.
+    Since the checksum is a part of the key, the entries of the old SBML file are never hit;
+    they are also purged when the file change is detected.
+    The values are stored with the lists converted to tuples, and get() returns a copy of the dict,
+    so the callers may modify what they get.
+    """
+    def __init__(self, memory_budget: Optional[int] = None, ttl: Optional[float] = None, disk_dir: Optional[str] = None):
+        if memory_budget == None:
+            memory_budget = int(os.environ.get("KOSMOGORA_SOLUTION_CACHE_BYTES", DefaultMemoryBudget))
+        if ttl == None:
+            ttl = float(os.environ.get("KOSMOGORA_SOLUTION_CACHE_TTL", DefaultTTL))
+        if disk_dir == None:
+            disk_dir = os.environ.get("KOSMOGORA_SOLUTION_CACHE_DIR")
+        self.memory_budget = memory_budget
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self.entries = OrderedDict()
+        self.total_size = 0
+        self.lock = threading.Lock()
+        # {base model path: checksum}, to detect the change of the SBML file.
+        self.checksums = {}
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def make_key(self, base_model_path: str, bounds: Dict[str, Tuple[float, float]],
+            analysis: str = "FBA", params: Optional[Dict] = None):
+        """ Returns the key. 'bounds' is {reaction_id: (lower_bound, upper_bound)}, and its order is ignored. """
+        path = os.path.abspath(base_model_path)
+        checksum = source_checksum(path)
+        self._check_source(path, checksum)
+        canonical = json.dumps([
+            checksum, analysis, params,
+            sorted([rxn_id, float(lb), float(ub)] for rxn_id, (lb, ub) in bounds.items())
+        ], sort_keys=True)
+        digest = hashlib.sha256(canonical.encode()).hexdigest()
+        return (path, checksum, digest)
+
+    def _check_source(self, path: str, checksum: str):
+        with self.lock:
+            old_checksum = self.checksums.get(path)
+            self.checksums[path] = checksum
+            if old_checksum == None or old_checksum == checksum:
+                return
+            print("{} is changed. Purge the cached solutions.".format(path))
+            for key in [key for key in self.entries if key[0] == path]:
+                self._remove(key)
+        if self.disk_dir != None:
+            shutil.rmtree(os.path.join(self.disk_dir, old_checksum), ignore_errors=True)
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.total_size -= entry.size
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[1], key[2] + ".pkl")
+
+    def get(self, key):
+        """ Returns the cached value, or None. """
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry != None:
+                if now < entry.expires_at:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return _copy(entry.value)
+                self._remove(key)
+
+        if self.disk_dir != None:
+            disk_path = self._disk_path(key)
+            try:
+                if now < os.path.getmtime(disk_path) + self.ttl:
+                    with open(disk_path, 'rb') as f:
+                        data = f.read()
+                    value = _freeze(pickle.loads(data))
+                    self._put_memory(key, value, len(data), os.path.getmtime(disk_path) + self.ttl)
+                    with self.lock:
+                        self.disk_hits += 1
+                    return _copy(value)
+                os.remove(disk_path)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                pass
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def _put_memory(self, key, value, size: int, expires_at: float):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            if self.memory_budget < size:
+                return
+            self.entries[key] = _CacheEntry(value, size, expires_at)
+            self.total_size += size
+            while self.memory_budget < self.total_size:
+                self._remove(next(iter(self.entries)))
+
+    def put(self, key, value):
+        value = _freeze(value)
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        self._put_memory(key, value, len(data), time.time() + self.ttl)
+        if self.disk_dir != None:
+            disk_path = self._disk_path(key)
+            os.makedirs(os.path.dirname(disk_path), exist_ok=True)
+            tmp_path = "{}.{}.tmp".format(disk_path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, disk_path)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_size = 0
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.disk_hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_ratio": ((self.hits + self.disk_hits) / total) if 0 < total else 0.0,
+                "entries": len(self.entries),
+                "bytes": self.total_size,
+                "memory_budget": self.memory_budget,
+            }
+
+
+solution_cache = SolutionCache()
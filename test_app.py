@@ -1,9 +1,31 @@
 from fastapi.testclient import TestClient
 from app import app
+import os
+import shutil
 import urllib.parse
+import pytest
 
 client=TestClient(app)
 
+@pytest.fixture(autouse=True)
+def registry_dir(tmp_path, monkeypatch):
+    """ Save the user models and the jobs under tmp_path, not into ./data2 and ./manager2. """
+    import app as app_module
+    import obj_manager
+    from jobs import job_manager
+    meta_dir = os.path.join(str(tmp_path), "manager2")
+    data_dir = os.path.join(str(tmp_path), "data2")
+    shutil.copytree(obj_manager.MetaInfoDir, meta_dir, ignore=shutil.ignore_patterns("*.lock"))
+    os.mkdir(data_dir)
+    monkeypatch.setattr(obj_manager, "MetaInfoDir", meta_dir)
+    monkeypatch.setattr(obj_manager, "DataDir", data_dir)
+    monkeypatch.setattr(obj_manager, "BaseModelList", os.path.join(meta_dir, "base_model_list.yaml"))
+    monkeypatch.setattr(obj_manager, "ViewList", os.path.join(meta_dir, "view_list.yaml"))
+    monkeypatch.setattr(obj_manager, "UserModificationList", os.path.join(meta_dir, "modifications_list.yaml"))
+    monkeypatch.setattr(app_module, "DataDir", data_dir)
+    monkeypatch.setattr(app_module, "object_manager", obj_manager.ModelViewManager())
+    monkeypatch.setattr(job_manager, "db_path", os.path.join(str(tmp_path), "jobs.sqlite"))
+
 def test_list_models():
     response = client.get("/list_models/")
     assert response.status_code == 200
@@ -30,28 +52,421 @@ def test_solve_normal():
     assert response.status_code == 200
 
 def test_solve_diff():
-    query_normal = "/solve2/sample1/"
+    query_normal = "/solve/sample1/"
     #response_normal = client.get(urllib.parse.quote(query_normal))
     response_normal = client.get(query_normal)
     assert response_normal.status_code == 200
     print(response_normal.json())
 
     #query_mod = "/solve/sample1?commands=knockout#AtoB"
-    query_mod = "/solve2/sample1?command=knockout-AtoB"
+    query_mod = "/solve/sample1?command=knockout-AtoB"
     print(urllib.parse.quote(query_mod))
     #response_mod =    client.get(urllib.parse.quote(query_mod))
     response_mod =    client.get(query_mod)
     assert response_mod.status_code == 200
-    assert response_normal != response_mod
+    assert response_normal.json() != response_mod.json()
     print(response_mod.json())
 
 def test_solve_viewid():
     #query_mod = "/solve/sample1?commands=knockout#AtoB"
-    query1 = "/solve2/sample1?command=knockout-AtoB"
+    query1 = "/solve/sample1?command=knockout-AtoB"
     response1 =    client.get(query1)
+    assert response1.status_code == 200
 
-    query2 = "/solve2/sample1?command=knockout-97&view_name=sample1"
+    query2 = "/solve/sample1?command=knockout-97&view_name=sample1"
     response2 =    client.get(query2)
+    assert response2.status_code == 200
     assert response1.json() == response2.json()
     print(response1.json())
 
+
+def test_model_cache_isolation():
+    response_mod = client.get("/solve/sample1/?command=knockout-Atrans")
+    assert response_mod.status_code == 200
+    response_normal = client.get("/solve/sample1/")
+    assert response_normal.status_code == 200
+    assert response_normal.json() != response_mod.json()
+    stats = client.get("/cache_stats").json()["model_cache"]
+    assert 1 <= stats["hits"]
+
+def test_reaction_information():
+    response = client.get("/reaction_information/iJO1366/MDH")
+    assert response.status_code == 200
+    assert response.json()["reaction_information"]["ID"] == "MDH"
+
+def test_metabolite_information():
+    response = client.get("/metabolite_information/iJO1366/nadh_c")
+    assert response.status_code == 200
+    response = client.get("/metabolite_information/iJO1366/no_such_metabolite")
+    assert response.status_code == 404
+
+def test_convert_ids():
+    response = client.get("/convert_ids/sample1?target_db=metanetx")
+    assert response.status_code == 200
+    ret = response.json()
+    assert ret["mapping"]["AtoB"] == ["MNXR0001"]
+    assert "AtoC" in ret["unmapped"]
+
+def test_reaction_information_batch():
+    response = client.post("/reaction_information/sample1", json={"ids": ["97", "98"], "view_name": "sample1"})
+    assert response.status_code == 200
+    ret = response.json()
+    assert ret["reaction_information"]["97"]["ID"] == "AtoB"
+    assert ret["not_found"] == ["98"]
+
+def test_metabolite_information_batch():
+    response = client.post("/metabolite_information/iJO1366", json={"ids": ["nadh_c", "no_such_metabolite"]})
+    assert response.status_code == 200
+    ret = response.json()
+    assert "nadh_c" in ret["metabolite_information"]
+    assert ret["not_found"] == ["no_such_metabolite"]
+
+def test_open_view_range():
+    response = client.get("/open_view/sample1")
+    assert response.status_code == 200
+    whole = response.content
+    response = client.get("/open_view/sample1", headers={"Range": "bytes=10-19"})
+    assert response.status_code == 206
+    assert response.content == whole[10:20]
+    assert response.headers["Content-Range"] == "bytes 10-19/{}".format(len(whole))
+    response = client.get("/open_view/sample1", headers={"Range": "bytes=-5"})
+    assert response.status_code == 206
+    assert response.content == whole[-5:]
+    response = client.get("/open_view/sample1", headers={"Range": "bytes={}-".format(len(whole))})
+    assert response.status_code == 416
+
+def test_solution_cache_isolation():
+    from solution_cache import SolutionCache
+    cache = SolutionCache(disk_dir=None)
+    key = ("path", "checksum", "digest")
+    cache.put(key, {"fluxes": [["A", 1.0]], "objective_value": 1.0})
+    data = cache.get(key)
+    data["objective_value"] = 2.0
+    try:
+        data["fluxes"].append(["B", 2.0])
+    except AttributeError:
+        pass
+    assert cache.get(key) == {"fluxes": (("A", 1.0),), "objective_value": 1.0}
+
+def test_solution_cache():
+    response1 = client.get("/solve/sample1/?command=knockout-Atrans&command=bound-AtoB-0-10")
+    hits = client.get("/cache_stats").json()["solution_cache"]["hits"]
+    # The same modification set in the different order
+    response2 = client.get("/solve/sample1/?command=bound-AtoB-0-10&command=knockout-Atrans")
+    assert response1.json() == response2.json()
+    assert client.get("/cache_stats").json()["solution_cache"]["hits"] == hits + 1
+
+def test_solve_batch():
+    scenarios = [[], ["knockout-Atrans"], ["knockout-no_such_reaction"]]
+    response = client.post("/solve_batch/sample1/", json={"scenarios": scenarios, "objective_only": True})
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert results[0]["objective_value"] == client.get("/solve/sample1/").json()["objective_value"]
+    assert results[1]["objective_value"] == 0.0
+    assert "error" in results[2]
+
+def test_solve_formats():
+    pairs = client.get("/solve/sample1/").json()
+    index = client.get("/reaction_index/sample1").json()
+    columnar = client.get("/solve/sample1/?format=columnar").json()
+    assert columnar["version"] == index["version"]
+    assert dict(zip(index["reaction_ids"], columnar["fluxes"])) == dict(pairs["fluxes"])
+    sparse = client.get("/solve/sample1/?format=sparse").json()
+    assert dict(sparse["fluxes"]) == {k: v for (k, v) in pairs["fluxes"] if v != 0}
+    response = client.get("/solve/sample1/?format=npy")
+    assert response.status_code == 200
+    assert float(response.headers["X-Objective-Value"]) == pairs["objective_value"]
+    assert client.get("/solve/sample1/?format=unknown").status_code == 400
+
+def test_solve_delta():
+    full = client.get("/solve/sample1/?command=knockout-Atrans").json()
+    base = client.get("/solve/sample1/").json()
+    response = client.get("/solve/sample1/?command=knockout-Atrans&reference=base")
+    assert response.status_code == 200
+    delta = response.json()
+    assert delta["objective_value"] == full["objective_value"]
+    assert delta["reference_objective_value"] == base["objective_value"]
+    base_fluxes = dict(base["fluxes"])
+    expected = [k for (k, v) in full["fluxes"] if v != base_fluxes[k]]
+    assert [k for (k, _, _) in delta["changed"]] == expected
+    assert client.get("/solve/sample1/?reference=base&format=sparse").status_code == 400
+    assert client.get("/solve/sample1/?reference=base&stream=true").status_code == 400
+
+def test_save_compiled_user_model():
+    import uuid
+    new_model_name = "test_{}".format(uuid.uuid4().hex)
+    response = client.get("/save/sample1/tester/{}?command=knockout-97&command=bound-98-0-5&view_name=sample1".format(new_model_name))
+    assert response.status_code == 200
+    user_model = client.get("/open_user_model/{}".format(new_model_name)).json()
+    assert [b[1:] for b in user_model["compiled"]["bounds"]] == [["AtoB", 0.0, 0.0], ["AtoC", 0.0, 5.0]]
+    response_user = client.get("/solve/{}/".format(new_model_name))
+    response_base = client.get("/solve/sample1/?command=knockout-AtoB&command=bound-AtoC-0-5")
+    assert response_user.json() == response_base.json()
+    response = client.get("/save/sample1/tester/{}_x?command=knockout-no_such_reaction".format(new_model_name))
+    assert response.status_code == 400
+
+def test_solve_job():
+    import time
+    response = client.post("/jobs/solve/sample1/", json={"command": ["knockout-Atrans"]})
+    assert response.status_code == 200
+    job_id = response.json()["job_id"]
+    # The identical submission shares the job.
+    assert client.post("/jobs/solve/sample1/", json={"command": ["knockout-Atrans"]}).json()["job_id"] == job_id
+    for _ in range(100):
+        if client.get("/jobs/{}".format(job_id)).json()["status"] == "done":
+            break
+        time.sleep(0.1)
+    response = client.get("/jobs/{}/result".format(job_id))
+    assert response.status_code == 200
+    assert response.json() == client.get("/solve/sample1/?command=knockout-Atrans").json()
+
+def test_fva():
+    response = client.get("/fva/sample1/?reaction=97&reaction=99&view_name=sample1")
+    assert response.status_code == 200
+    ret = response.json()
+    assert [r[0] for r in ret["ranges"]] == ["AtoB", "CtoB"]
+    response = client.get("/fva/sample1/?restrict_to_view=true&view_name=sample1&command=knockout-94")
+    assert response.status_code == 200
+    assert all(r[1] == 0.0 and r[2] == 0.0 for r in response.json()["ranges"])
+
+def test_metrics():
+    # A scenario not solved by the other tests, not to be served from the solution cache.
+    response = client.get("/solve/sample1/?command=bound-AtoC-0-123")
+    assert response.status_code == 200
+    assert "optimize;dur=" in response.headers["Server-Timing"]
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert 'kosmogora_stage_duration_seconds_count{stage="optimize"}' in response.text
+    assert 'kosmogora_requests_total{route="/solve/{model_name}/",method="GET",status="200"}' in response.text
+    assert 'kosmogora_solver_status_total{status="optimal"}' in response.text
+
+def test_profile_request(tmp_path):
+    import os
+    from profiling import request_profiler
+    response = client.get("/solve/sample1/", headers={"X-Kosmogora-Profile": "1"})
+    # Disabled by default
+    assert not "X-Kosmogora-Profile-Path" in response.headers
+    request_profiler.enabled = True
+    request_profiler.directory = str(tmp_path)
+    try:
+        response = client.get("/solve/sample1/?command=bound-AtoC-0-321",
+                headers={"X-Kosmogora-Profile": "1", "X-Request-ID": "test-profile"})
+    finally:
+        request_profiler.enabled = False
+    assert response.status_code == 200
+    assert response.headers["X-Request-ID"] == "test-profile"
+    path = response.headers["X-Kosmogora-Profile-Path"]
+    assert os.path.basename(path) == "test-profile.pstats"
+    assert os.path.isfile(path)
+
+def test_solve_stream():
+    for flux_format in ("pairs", "sparse", "columnar"):
+        query = "/solve/iJO1366/?format={}".format(flux_format)
+        response = client.get(query + "&stream=true")
+        assert response.status_code == 200
+        assert response.json() == client.get(query).json()
+
+def test_api_information():
+    response = client.get("/apis/?api_id=solve")
+    assert response.status_code == 200
+    assert response.json()["httpMethod"] == "GET"
+    assert client.get("/apis/?api_id=no_such_api").status_code == 404
+
+def test_conditional_requests():
+    import uuid
+    import obj_manager
+    # Written at the registration
+    obj_manager.compress_static_files()
+    response = client.get("/open_sbml/iJO1366", headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["Vary"] == "Accept-Encoding"
+    etag = response.headers["ETag"]
+    assert client.get("/open_sbml/iJO1366", headers={"Accept-Encoding": "gzip", "If-None-Match": etag}).status_code == 304
+    identity = client.get("/open_sbml/iJO1366", headers={"Accept-Encoding": "identity"})
+    assert not "Content-Encoding" in identity.headers
+    assert identity.headers["ETag"] != etag
+    assert identity.content == response.content
+    last_modified = identity.headers["Last-Modified"]
+    assert client.get("/open_sbml/iJO1366", headers={"Accept-Encoding": "identity", "If-Modified-Since": last_modified}).status_code == 304
+
+    new_model_name = "test_{}".format(uuid.uuid4().hex)
+    assert client.get("/save/sample1/tester/{}?command=knockout-AtoB".format(new_model_name)).status_code == 200
+    for query in ("/open_view/iJO1366", "/get_model_property/iJO1366", "/get_view_property/iJO1366",
+            "/open_user_model/{}".format(new_model_name)):
+        response = client.get(query)
+        assert response.status_code == 200
+        response_again = client.get(query, headers={"If-None-Match": response.headers["ETag"]})
+        assert response_again.status_code == 304
+        assert response_again.content == b""
+
+def test_registry_partial_line(tmp_path):
+    import yaml
+    from registry import UserModelRegistry
+    path = str(tmp_path / "modifications_list.yaml")
+    with open(path, "w") as file:
+        yaml.dump({"user_models": {}}, file)
+    registry = UserModelRegistry(path, "user_models", compact_threshold=3)
+    registry.append("a", {"parent": "sample1"})
+    # Torn by a crash while appending
+    with open(registry.journal_path, "ab") as f:
+        f.write(b'{"name": "broken", "prop')
+    registry.append("b", {"parent": "sample1"})
+    assert sorted(registry.load()) == ["a", "b"]
+    registry.append("c", {"parent": "sample1"})
+    # Compacted at the 3rd entry
+    assert os.path.getsize(registry.journal_path) == 0
+    assert sorted(registry.load()) == ["a", "b", "c"]
+
+def test_jobs_shared_among_processes(tmp_path):
+    import json
+    import time
+    import threading
+    from jobs import JobManager
+    db_path = str(tmp_path / "jobs.sqlite")
+    # Two managers on the same file, as two server processes
+    manager, other = JobManager(threads=1, db_path=db_path), JobManager(threads=1, db_path=db_path)
+    release = threading.Event()
+    def run(job):
+        release.wait(10)
+        return {"value": 1}
+    job = manager.submit("test", [1], run)
+    queued = manager.submit("test", [2], run)
+    assert other.submit("test", [1], run).id == job.id
+    assert other.cancel(queued.id).status == "cancelled"
+    release.set()
+    for _ in range(100):
+        if other.get(job.id).status == "done":
+            break
+        time.sleep(0.05)
+    assert json.loads(other.get(job.id).result) == {"value": 1}
+    assert other.status_counts() == {"done": 1, "cancelled": 1}
+
+def test_missing_variant(tmp_path):
+    import http_cache
+    path = str(tmp_path / "model.xml")
+    with open(path, "w") as f:
+        f.write("<sbml/>" * 1000)
+    response = http_cache.file_response({"accept-encoding": "gzip"}, path, "application/xml")
+    # Served as it is. The variant is not written per request.
+    assert not "Content-Encoding" in response.headers
+    assert not os.path.exists(path + ".gz")
+    http_cache.prepare_variants(path)
+    response = http_cache.file_response({"accept-encoding": "gzip"}, path, "application/xml")
+    assert response.headers["Content-Encoding"] == "gzip"
+
+def _worker_state():
+    from model_cache import model_cache
+    return os.getpid(), model_cache.stats()["entries"]
+
+def test_worker_pool():
+    import time
+    from worker_pool import WorkerPool, WorkerPoolBusy
+    pool = WorkerPool(workers=1, queue_size=1, timeout=0.1, max_tasks_per_child=2)
+    try:
+        pid, entries = pool.run(_worker_state)
+        # Preloaded by the initializer
+        assert 0 < entries
+        future = pool.submit(time.sleep, 1)
+        with pytest.raises(WorkerPoolBusy):
+            pool.submit(time.sleep, 0)
+        future.result()
+        for _ in range(50):
+            if 2 <= pool.completed:
+                break
+            time.sleep(0.1)
+        # Recycled after 2 tasks
+        assert pool.run(_worker_state)[0] != pid
+    finally:
+        pool.shutdown()
+
+def test_worker_pool_busy(monkeypatch):
+    from worker_pool import worker_pool, WorkerPoolBusy
+    def busy(*args):
+        raise WorkerPoolBusy("Too many requests are queued.")
+    monkeypatch.setattr(worker_pool, "run", busy)
+    response = client.get("/solve/sample1/")
+    assert response.status_code == 503
+
+def test_fva_chunks(monkeypatch):
+    from app import load_model_handler
+    from worker_pool import worker_pool
+    from solution_cache import solution_cache
+    inline = load_model_handler("sample1").do_FVA(None, 0.9, 2)
+    solution_cache.clear()
+    monkeypatch.setattr(worker_pool, "workers", 2)
+    try:
+        # Split into 2 chunks, run in the worker processes
+        assert load_model_handler("sample1").do_FVA(None, 0.9, 2) == inline
+    finally:
+        worker_pool.shutdown()
+    assert len(inline["ranges"]) == 6
+
+def test_stale_compiled_model(tmp_path, monkeypatch):
+    import pickle
+    import cobra.io
+    import compiled_model
+    sbml_path = str(tmp_path / "sample1.xml")
+    shutil.copyfile("./models/sample1.xml", sbml_path)
+    parsed = []
+    read_sbml_model = cobra.io.read_sbml_model
+    def counting_read_sbml_model(path):
+        parsed.append(path)
+        return read_sbml_model(path)
+    monkeypatch.setattr(cobra.io, "read_sbml_model", counting_read_sbml_model)
+
+    def assert_fallback_and_recompile():
+        assert compiled_model.load_compiled_model(sbml_path) == None
+        count = len(parsed)
+        assert len(compiled_model.load_model(sbml_path).reactions) == 6
+        # Parsed from the SBML file
+        assert len(parsed) == count + 1
+        compiled_model.compile_model(sbml_path)
+        assert compiled_model.load_compiled_model(sbml_path) != None
+
+    compiled_model.compile_model(sbml_path)
+    path = compiled_model.compiled_path(sbml_path)
+    for field, value in (("format_version", -1), ("cobra_version", "0.0.0"), ("source_sha256", "0" * 64)):
+        with open(path, "rb") as f:
+            header = pickle.load(f)
+            body = f.read()
+        header[field] = value
+        with open(path, "wb") as f:
+            pickle.dump(header, f)
+            f.write(body)
+        assert_fallback_and_recompile()
+    # Truncated
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) // 2)
+    assert_fallback_and_recompile()
+    # The source is changed
+    with open(sbml_path, "a") as f:
+        f.write("\n")
+    assert_fallback_and_recompile()
+
+def test_launcher_replaces_workers(monkeypatch):
+    import time
+    import launcher
+    forked = []
+    def fork():
+        forked.append(200 + len(forked))
+        return forked[-1]
+    sleeps = []
+    stopping = []
+    # Worker 100 is killed, its replacement 200 dies at once, then the launcher is stopped while 201 runs.
+    events = [(100, 9), (200, 9 << 8), (0, 0), (201, 0)]
+    def waitpid(pid, options):
+        event = events.pop(0)
+        if event[0] == 0:
+            stopping.append(15)
+        return event
+    monkeypatch.setattr(launcher.os, "fork", fork)
+    monkeypatch.setattr(launcher.os, "waitpid", waitpid)
+    monkeypatch.setattr(launcher.time, "sleep", sleeps.append)
+    pids = [100]
+    started = {100: time.monotonic() - 3600}
+    launcher.supervise(pids, started, lambda: launcher.start_worker(None, "127.0.0.1", 8000), stopping)
+    assert forked == [200, 201]
+    assert pids == [] and started == {}
+    # Only the replacement of the worker which died at once is delayed.
+    assert sleeps.count(launcher.RestartDelay) == 1
@@ -0,0 +1,61 @@
+import os
+import json
+import threading
+from metrics import stage
+
+class ViewTables:
+    """ ID translation tables compiled from a view (.cyjs) file.
+
+    edge_to_reaction: {edge ID: reaction ID}
+    node_to_metabolite: {node ID: metabolite ID} (metabolite nodes only)
+    reaction_to_edges, metabolite_to_nodes: reverse maps. One reaction can be drawn as multiple edges.
+    """
+    def __init__(self, view):
+        self.edge_to_reaction = {}
+        self.node_to_metabolite = {}
+        self.reaction_to_edges = {}
+        self.metabolite_to_nodes = {}
+        for edge in view["elements"]["edges"]:
+            edge_id = edge["data"]["id"]
+            rxn_id = edge["data"]["name"]
+            self.edge_to_reaction[edge_id] = rxn_id
+            self.reaction_to_edges.setdefault(rxn_id, []).append(edge_id)
+        for node in view["elements"]["nodes"]:
+            if node["data"].get("node_type") == "metabolite":
+                node_id = node["data"]["id"]
+                mtb_id = node["data"]["name"]
+                self.node_to_metabolite[node_id] = mtb_id
+                self.metabolite_to_nodes.setdefault(mtb_id, []).append(node_id)
+
+
+class ViewCache:
+    """ Process-wide cache of the ViewTables, invalidated when the view file changes. """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, view_path: str) -> ViewTables:
+        path = os.path.abspath(view_path)
+        st = os.stat(path)
+        signature = (st.st_mtime_ns, st.st_size)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry != None and entry[0] == signature:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        with stage("view_map"):
+            with open(path, 'r') as f:
+                tables = ViewTables(json.load(f))
+        with self.lock:
+            self.entries[path] = (signature, tables)
+        return tables
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries)}
+
+
+view_cache = ViewCache()
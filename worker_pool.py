@@ -0,0 +1,159 @@
+import os
+import threading
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+import metrics
+from profiling import request_profiler
+
+# The pool can be configured by the following environment variables.
+#   KOSMOGORA_WORKERS:           number of the worker processes. 0 means running in the request thread (default).
+#   KOSMOGORA_WORKER_QUEUE:      maximum number of the tasks submitted at once (default: 4 * KOSMOGORA_WORKERS).
+#   KOSMOGORA_WORKER_TIMEOUT:    seconds to wait for a free slot of the queue (default: 30).
+#   KOSMOGORA_WORKER_MAX_TASKS:  the workers are recycled after this number of tasks per worker (default: 1000).
+
+class WorkerPoolBusy(Exception):
+    """ Raised when the queue of the pool is full. """
+    pass
+
+# True in the worker processes of the pool.
+_in_worker = False
+
+def in_worker_process() -> bool:
+    """ The worker runs one task at a time, so the task may hold a cached model as long as it needs. """
+    return _in_worker
+
+def _preload(model_paths):
+    """ Initializer of the worker process. Parse the base models in advance. """
+    global _in_worker
+    _in_worker = True
+    from model_cache import model_cache
+    for path in model_paths:
+        try:
+            model_cache.get_entry(path)
+        except Exception as e:
+            print("worker {}: failed to preload {}: {}".format(os.getpid(), path, e))
+
+def _run_with_metrics(fn, *args):
+    """ Run in the worker process. The timings are returned to be merged into the request. """
+    collector, token = metrics.start_collector()
+    try:
+        return fn(*args), collector.export()
+    finally:
+        metrics.stop_collector(token)
+
+def _registered_model_paths():
+    import yaml
+    from obj_manager import BaseModelList, ModelRootKey
+    try:
+        with open(BaseModelList) as file:
+            base_model_set = yaml.safe_load(file)[ModelRootKey]
+    except (OSError, KeyError, TypeError):
+        return []
+    return [p["path"] for p in base_model_set.values() if os.path.isfile(p["path"])]
+
+
+class WorkerPool:
+    """ Pool of the worker processes which keep the base models resident.
+
+    CPU-bound work (SBML parsing, model modifications and solving) is run in the workers,
+    so that the requests are not serialized by the GIL.
+    The callable and its arguments must be picklable, e.g. a bound method of ModelHandler.
+    The workers are replaced by a new pool after workers * max_tasks_per_child tasks,
+    i.e. max_tasks_per_child tasks per worker on average.
+    """
+    def __init__(self, workers: Optional[int] = None, queue_size: Optional[int] = None,
+            timeout: Optional[float] = None, max_tasks_per_child: Optional[int] = None):
+        if workers == None:
+            workers = int(os.environ.get("KOSMOGORA_WORKERS", 0))
+        if queue_size == None:
+            queue_size = int(os.environ.get("KOSMOGORA_WORKER_QUEUE", 4 * workers))
+        if timeout == None:
+            timeout = float(os.environ.get("KOSMOGORA_WORKER_TIMEOUT", 30))
+        if max_tasks_per_child == None:
+            max_tasks_per_child = int(os.environ.get("KOSMOGORA_WORKER_MAX_TASKS", 1000))
+        self.workers = workers
+        self.queue_size = max(queue_size, 1)
+        self.timeout = timeout
+        self.max_tasks_per_child = max_tasks_per_child
+        self.slots = threading.BoundedSemaphore(self.queue_size)
+        self.lock = threading.Lock()
+        self.executor = None
+        # Number of the tasks submitted and not finished.
+        self.pending = 0
+        # Number of the tasks finished by the current executor.
+        self.completed = 0
+
+    def enabled(self) -> bool:
+        return 0 < self.workers
+
+    def _get_executor(self):
+        with self.lock:
+            if self.executor != None and self.workers * self.max_tasks_per_child <= self.completed:
+                # Recycle the workers, to cap the memory growth. The running tasks of the old pool finish.
+                # (ProcessPoolExecutor's max_tasks_per_child is not used: it is new in Python 3.11.)
+                print("recycle the worker processes after {} tasks".format(self.completed))
+                self.executor.shutdown(wait=False)
+                self.executor = None
+            if self.executor == None:
+                self.executor = ProcessPoolExecutor(
+                        max_workers=self.workers,
+                        mp_context=multiprocessing.get_context("spawn"),
+                        initializer=_preload,
+                        initargs=(_registered_model_paths(),))
+                self.completed = 0
+            return self.executor
+
+    def submit(self, fn, *args):
+        """ Submit the task and returns the Future. Raises WorkerPoolBusy if the queue is full. """
+        if not self.slots.acquire(timeout=self.timeout):
+            raise WorkerPoolBusy("Too many requests are queued.")
+        try:
+            executor = self._get_executor()
+            future = executor.submit(fn, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        with self.lock:
+            self.pending += 1
+        future.add_done_callback(functools.partial(self._task_done, executor))
+        return future
+
+    def _task_done(self, executor, _):
+        with self.lock:
+            self.pending -= 1
+            if executor is self.executor:
+                self.completed += 1
+        self.slots.release()
+
+    def run(self, fn, *args):
+        """ Run fn(*args) in the pool and returns the result. If the pool is disabled, run it here. """
+        # The profiled request is run here, so that its profile covers the task.
+        if not self.enabled() or request_profiler.active():
+            return fn(*args)
+        with metrics.stage("worker_pool"):
+            result, exported = self.submit(_run_with_metrics, fn, *args).result()
+        metrics.merge(exported)
+        return result
+
+    def run_all(self, fn, args_list):
+        """ Run fn(*args) for each args in args_list at once in the pool, and returns the results in the order.
+        If the pool is disabled, they are run here in turn. """
+        if not self.enabled() or request_profiler.active():
+            return [fn(*args) for args in args_list]
+        with metrics.stage("worker_pool"):
+            futures = [self.submit(_run_with_metrics, fn, *args) for args in args_list]
+            outputs = [future.result() for future in futures]
+        for _, exported in outputs:
+            metrics.merge(exported)
+        return [result for result, _ in outputs]
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor != None:
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = None
+
+
+worker_pool = WorkerPool()